@@ -1,6 +1,6 @@
 import numpy as np
 from skimage.transform import resize
-from skimage.util import view_as_blocks
+from utils import LRUCache
 
 
 class BlockStatistics():
@@ -9,8 +9,14 @@ class BlockStatistics():
         self.name = "Block Statistics Function"
         self.description = ("Generates a downsampled output raster by computing a statistical "
                             "measure over non-overlapping square blocks of pixels in the input raster.")
-        self.func = np.mean
+        self.func = _blockMean
+        self.measure = 'mean'
         self.padding = 0
+        self.pyramid = False
+        # aggregate pyramid tiles of the input raster, by (level, row, column), up to 64 MB of them
+        self.tiles = LRUCache(64 << 20, sizeOf=lambda t: sum(z.nbytes for z in t))
+        self.tileSize = 64
+        self.source = None
 
     def getParameterInfo(self):
         return [
@@ -50,6 +56,16 @@ class BlockStatistics():
                 'description': ("The integer factor by which the output raster is "
                                 "downsampled relative to the input raster.")
             },
+            {
+                'name': 'pyramid',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': "Aggregate Pyramid",
+                'description': ("Keep the sum, count, minimum, and maximum of blocks of the input raster at "
+                                "every power-of-two factor, so that coarser requests are derived from "
+                                "finer results. Applies to the Minimum, Maximum, Mean, and Sum measures.")
+            },
         ]
 
     def getConfiguration(self, **scalars):
@@ -74,17 +90,26 @@ class BlockStatistics():
 
         m = kwargs.get('measure')
         m = m.lower() if m is not None and len(m) else 'mean'
+        self.measure = m
+        self.pyramid = bool(kwargs.get('pyramid', False))
+
+        # tiles of the pyramid belong to one input raster
+        r = kwargs['raster_info']
+        source = (tuple(r.get('extent', ())), tuple(r.get('cellSize', ())), r.get('bandCount'))
+        if source != self.source:
+            self.tiles.clear()
+            self.source = source
 
         if m == 'minimum':
-            self.func = np.min
+            self.func = _blockMinimum
         elif m == 'maximum':
-            self.func = np.max
+            self.func = _blockMaximum
         elif m == 'mean':
-            self.func = np.mean
+            self.func = _blockMean
         elif m == 'median':
-            self.func = np.median
+            self.func = _blockMedian
         elif m == 'sum':
-            self.func = np.sum
+            self.func = _blockSum
         elif m == 'nearest':
             self.func = None
 
@@ -96,20 +121,135 @@ class BlockStatistics():
 
         if self.func is None:
             b = resize(p, shape, order=0, preserve_range=True)
+            pixelBlocks['output_pixels'] = b.astype(props['pixelType'], copy=False)
+            pixelBlocks['output_mask'] = resize(m, shape, order=0, preserve_range=True).astype('u1', copy=False)
+            return pixelBlocks
+
+        # split rows and columns into (blocks, pixels in block) axes, leaving out any padding around them
+        rows, cols = shape[-2:]
+        fy, fx = p.shape[-2] // rows, p.shape[-1] // cols
+        y, x = (p.shape[-2] - fy * rows) // 2, (p.shape[-1] - fx * cols) // 2
+
+        def blocks(a):
+            a = a[..., y:y + fy * rows, x:x + fx * cols]
+            return a.reshape(a.shape[:-2] + (rows, fy, cols, fx))
+
+        f = fy
+        if self.pyramid and self.measure in ('minimum', 'maximum', 'mean', 'sum') and fx == f > 1 and not f & (f - 1):
+            a = p[..., y:y + fy * rows, x:x + fx * cols], m[..., y:y + fy * rows, x:x + fx * cols]
+            s, n, lo, hi = self._aggregates(tlc, a, rows, cols, f)
+            b = {'minimum': lo, 'maximum': hi, 'sum': s, 'mean': s / np.maximum(n, 1)}[self.measure].astype('f4')
         else:
-            blockSizes = tuple(np.divide(p.shape, shape))
-            b = np.ma.masked_array(view_as_blocks(p, blockSizes),
-                                   view_as_blocks(~m.astype('b1'), blockSizes))
-            for i in range(len(b.shape) // 2):
-                b = self.func(b, axis=-1)
-            b = b.data
-
-        d = self.padding
+            v = blocks(m != 0)
+            n = v.sum(axis=(-3, -1))                # valid pixels in each block
+            b = self.func(blocks(p).astype('f4'), v, n)
+        b[n == 0] = 0
+
         pixelBlocks['output_pixels'] = b.astype(props['pixelType'], copy=False)
-        pixelBlocks['output_mask'] = resize(m, shape, order=0, preserve_range=True).astype('u1', copy=False)
+        pixelBlocks['output_mask'] = (n > 0).astype('u1')
         return pixelBlocks
 
+    def _aggregates(self, tlc, pixels, rows, cols, f):
+        # Returns the (sum, count, minimum, maximum) of the valid pixels of each output block. tlc is the
+        # output block's top-left corner in output pixels, that is, in blocks of f input pixels from the
+        # raster's origin, so output blocks line up with the tiles of every level of the pyramid.
+        # The output is assembled from tiles of level log2(f), or of finer levels, if they are all
+        # known. Otherwise it is computed from the pixels, keeping each whole tile of every level.
+        level = f.bit_length() - 1
+        r0, c0 = int(round(tlc[1])), int(round(tlc[0]))
+        T = self.tileSize
+
+        tiles = [(i, j) for i in range(r0 // T, (r0 + rows - 1) // T + 1)
+                 for j in range(c0 // T, (c0 + cols - 1) // T + 1)]
+        found = []
+        for i, j in tiles:
+            t = self._tile(level, i, j)
+            if t is None:
+                break
+            found.append(t)
+        else:
+            out = [np.empty(z.shape[:-2] + (rows, cols), dtype=z.dtype) for z in found[0]]
+            for (i, j), t in zip(tiles, found):
+                ra, rb = max(r0, i * T), min(r0 + rows, (i + 1) * T)
+                ca, cb = max(c0, j * T), min(c0 + cols, (j + 1) * T)
+                for o, z in zip(out, t):
+                    o[..., ra - r0:rb - r0, ca - c0:cb - c0] = z[..., ra - i * T:rb - i * T, ca - j * T:cb - j * T]
+            return out
+
+        x, m = pixels
+        v = m != 0
+        a = (np.where(v, x, 0.).astype('f8'), v.astype('i4'),
+             np.where(v, x, np.inf).astype('f4'), np.where(v, x, -np.inf).astype('f4'))
+        for l in range(1, level + 1):
+            a = _coarsen(a)
+            k = 1 << (level - l)                    # cells of this level per output block
+            for i in range(-(-r0 * k // T), (r0 + rows) * k // T):
+                for j in range(-(-c0 * k // T), (c0 + cols) * k // T):
+                    y, x = i * T - r0 * k, j * T - c0 * k
+                    self.tiles.put((l, i, j), tuple(z[..., y:y + T, x:x + T].copy() for z in a))
+        return a
+
+    def _tile(self, level, i, j):
+        # a tile of the pyramid, or one made of the four tiles of the finer level below it
+        t = self.tiles.get((level, i, j))
+        if t is not None or level <= 1:
+            return t
+
+        children = []
+        for y in (0, 1):
+            for x in (0, 1):
+                c = self._tile(level - 1, 2 * i + y, 2 * j + x)
+                if c is None:
+                    return None
+                children.append(c)
+        a = tuple(np.concatenate((np.concatenate((children[0][k], children[1][k]), axis=-1),
+                                  np.concatenate((children[2][k], children[3][k]), axis=-1)), axis=-2)
+                  for k in range(4))
+        return self.tiles.put((level, i, j), _coarsen(a))
+
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:
             keyMetadata['datatype'] = 'Processed'
         return keyMetadata
+
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
+
+# Reductions of float32 pixels x over the block axes (-3, -1), given the valid pixels v and their count n
+# in each block. Invalid pixels are replaced by a value that doesn't affect the measure.
+
+def _coarsen(a):
+    # (sum, count, minimum, maximum) of blocks of 2x2 cells, from those of the cells
+    a = [z.reshape(z.shape[:-2] + (z.shape[-2] // 2, 2, z.shape[-1] // 2, 2)) for z in a]
+    return (a[0].sum(axis=(-3, -1)), a[1].sum(axis=(-3, -1)),
+            a[2].min(axis=(-3, -1)), a[3].max(axis=(-3, -1)))
+
+
+def _blockMinimum(x, v, n):
+    return np.where(v, x, np.inf).min(axis=(-3, -1))
+
+
+def _blockMaximum(x, v, n):
+    return np.where(v, x, -np.inf).max(axis=(-3, -1))
+
+
+def _blockSum(x, v, n):
+    return np.where(v, x, 0).sum(axis=(-3, -1), dtype='f4')
+
+
+def _blockMean(x, v, n):
+    return _blockSum(x, v, n) / np.maximum(n, 1)
+
+
+def _blockMedian(x, v, n):
+    # the pixels of each block along the last axis; invalid pixels are sorted to its end as +inf
+    x = np.moveaxis(x, -3, -2)
+    x = x.reshape(x.shape[:-2] + (-1,))
+    k = x.shape[-1]
+    if n.min() == k:
+        return np.median(x, axis=-1).astype('f4', copy=False)      # no invalid pixels: partitions
+    x = np.where(np.moveaxis(v, -3, -2).reshape(x.shape), x, np.inf)
+    x.sort(axis=-1)
+    lo = np.take_along_axis(x, (np.maximum(n, 1) - 1)[..., None] // 2, axis=-1)[..., 0]
+    hi = np.take_along_axis(x, (n // 2)[..., None], axis=-1)[..., 0]
+    return (lo + hi) / 2
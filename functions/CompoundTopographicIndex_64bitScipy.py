@@ -2,6 +2,8 @@ import numpy as np
 from math import sqrt
 from scipy import sparse as sp
 from scipy.sparse import linalg as splg
+from threading import Lock
+from utils import LRUCache
 
 class CompoundTopographicIndex_64bitScipy():
 
@@ -9,6 +11,7 @@ class CompoundTopographicIndex_64bitScipy():
         self.name = "Compound Topographic Index"
         self.description = ("Computes the compound topographic index (CTI), also "
                             "known as the topographic wetness index (TWI).")
+        self.router = None
 
     def getParameterInfo(self):
         return [
@@ -19,15 +22,37 @@ class CompoundTopographicIndex_64bitScipy():
                 'required': True,
                 'displayName': "DEM Raster",
                 'description': "The digital elevation model (DEM)."
+            },
+            {
+                'name': 'mode',
+                'dataType': 'string',
+                'value': 'Tile',
+                'required': False,
+                'displayName': "Flow Routing",
+                'domain': ('Tile', 'Whole Raster'),
+                'description': ("Accumulate flow within each requested tile only, or over the whole DEM, "
+                                "so that upstream areas continue across tile borders.")
+            },
+            {
+                'name': 'dem_path',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "DEM Dataset",
+                'description': ("Path of the DEM dataset, read tile by tile with arcpy by the "
+                                "Whole Raster flow routing.")
             }
         ]
 
     def getConfiguration(self, **scalars):
+        # the whole raster flow routing addresses the DEM by its native rows and columns
+        whole = str(scalars.get('mode', 'Tile')).lower() == 'whole raster'
         return {
             'compositeRasters': False,
             'inheritProperties': 1 | 2 | 4 | 8,     # inherit all from the raster
             'invalidateProperties': 2 | 4 | 8,      # reset stats, histogram, key properties
-            'inputMask': False
+            'inputMask': False,
+            'resampling': not whole                 # process at native resolution for Whole Raster
         }
 
     def updateRasterInfo(self, **kwargs):
@@ -37,6 +62,14 @@ class CompoundTopographicIndex_64bitScipy():
         kwargs['output_info']['histogram'] = ()  # reset histogram
         kwargs['output_info']['pixelType'] = 'f4'
         self.dem_cellsize = kwargs['dem_info']['cellSize']
+
+        self.router = None
+        if str(kwargs.get('mode', 'Tile')).lower() == 'whole raster':
+            info = kwargs['dem_info']
+            e, (cx, cy) = info['extent'], info['cellSize']
+            nRows, nCols = int(round((e[3] - e[1]) / cy)), int(round((e[2] - e[0]) / cx))
+            read = _arcpy_reader(str(kwargs['dem_path']), e, cx, cy)
+            self.router = FlowRouter(read, nRows, nCols, cx, cy)
         return kwargs
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
@@ -47,8 +80,14 @@ class CompoundTopographicIndex_64bitScipy():
         slope = calc_slope(inBlock_dem[0,:,:], cellSize[0])
         DX = cellSize[0]
         DY = cellSize[1]
-        flow_direction = calc_flow_direction_d8(DX, DY, inBlock_dem[0,:,:])
-        flow_accumulation = calc_flow_accumulation(flow_direction, inBlock_dem.shape)
+        if self.router is not None:
+            rows, cols = inBlock_dem.shape[-2:]
+            flow_accumulation = self.router.accumulation(int(tlc[1]), int(tlc[0]), rows, cols)
+            flow_accumulation = flow_accumulation.reshape(inBlock_dem.shape)
+            pixelBlocks['output_mask'] = np.isfinite(flow_accumulation).astype('u1')     # NoData in the DEM
+        else:
+            flow_direction = calc_flow_direction_d8(DX, DY, inBlock_dem[0,:,:])
+            flow_accumulation = calc_flow_accumulation(flow_direction, inBlock_dem.shape)
         cti = calc_cti(slope, flow_accumulation, cellSize[0])
 
         # format output cti pixels
@@ -83,7 +122,6 @@ def calc_flow_direction_d8(DX, DY, dem):
 
     nr = dem.shape[0]
     nc = dem.shape[1]
-    HYP = sqrt(DX*DX + DY*DY)
 
     ghost = np.zeros((nr+2, nc+2), 'd')
     ghost[1:-1, 1:-1] = dem[:, :]
@@ -104,41 +142,256 @@ def calc_flow_direction_d8(DX, DY, dem):
                                     -nr+1, 1, nr+1])
 
     neig_incr = neig_incr_col_major
-    slopes = np.zeros((8,), 'd')
+
+    # Ties go to the first maximum, as with argmax on each cell.
+    slopes = calc_d8_slopes(DX, DY, ghost)
+
+    # cells are numbered column major, as the neighbor increments assume
+    loc_max = slopes.argmax(axis=0).ravel(order='F')
+    downhill = slopes.max(axis=0).ravel(order='F') > 0
     all_indices = np.arange(nr*nc, dtype='i')
-    max_indices = np.zeros(nr*nc, 'i')
-    slope_vals = np.zeros(nr*nc, 'd')
-    slope_count = np.zeros(nr*nc, 'i')
-    for i in range(1, nr+1):
-        for j in range(1, nc+1):
-            #
-            slopes[0] = (ghost[i, j]-ghost[i, j+1])/DX
-            slopes[4] = (ghost[i, j]-ghost[i, j-1])/DX
-            #
-            slopes[1] = (ghost[i, j]-ghost[i-1, j+1])/HYP
-            slopes[2] = (ghost[i, j]-ghost[i-1, j])/DY
-            slopes[3] = (ghost[i, j]-ghost[i-1, j-1])/HYP
-            #
-            slopes[5] = (ghost[i, j]-ghost[i+1, j-1])/HYP
-            slopes[6] = (ghost[i, j]-ghost[i+1, j])/DY
-            slopes[7] = (ghost[i, j]-ghost[i+1, j+1])/HYP
-
-            glob_ind = (j-1)*nr + i-1  # local cell col major
-            loc_max = slopes.argmax()
-            if slopes[loc_max] > 0:
-                glob_max = min(max(glob_ind + neig_incr[loc_max], 0), nc*nr-1)
-                max_indices[glob_ind] = glob_max
-                slope_vals[glob_ind] = slopes[loc_max]
-                slope_count[glob_ind] = 1
+    glob_max = np.clip(all_indices + neig_incr[loc_max], 0, nc*nr-1)
+    max_indices = np.where(downhill, glob_max, 0).astype('i')
+    slope_count = downhill.astype('i')
 
     M = sp.csr_matrix((slope_count, (all_indices, max_indices)), shape=(nr*nc, nr*nc))
     return M
 
 
+def calc_d8_slopes(DX, DY, ghost):
+    # Drops from every inner cell of the ghost-padded DEM towards its eight neighbors, divided by their
+    # distance and stacked in the order E, NE, N, NW, W, SW, S, SE (that of the neighbor increments).
+    HYP = sqrt(DX*DX + DY*DY)
+    c = ghost[1:-1, 1:-1]
+    return np.stack(((c - ghost[1:-1, 2:])/DX,
+                     (c - ghost[:-2, 2:])/HYP,
+                     (c - ghost[:-2, 1:-1])/DY,
+                     (c - ghost[:-2, :-2])/HYP,
+                     (c - ghost[1:-1, :-2])/DX,
+                     (c - ghost[2:, :-2])/HYP,
+                     (c - ghost[2:, 1:-1])/DY,
+                     (c - ghost[2:, 2:])/HYP))
+
+
 def calc_flow_accumulation(M, dsh):
     #Backgroud found at http://adh.usace.army.mil/new_webpage/main/main_page.htm
     #Algorithm modified from http://adh.usace.army.mil/svn/adh/mfarthin/src/samsi/2013/topo/
 
+    # The accumulation solves (I - M')a = 1: every cell counts itself plus the accumulation of
+    # the cells that drain into it. As D8 gives each cell at most one receiver, the cells form
+    # a forest that is swept from the sources downstream, one front of cells at a time, where
+    # each cell passes its total on once all of its donors have passed theirs.
+    n = M.shape[0]
+    C = M.tocoo()
+    keep = C.data != 0
+    rows, receivers = C.row[keep], C.col[keep]
+    if np.any(np.bincount(rows, minlength=1) > 1) or np.any(rows == receivers) or np.any(C.data[keep] != 1):
+        return _solve_flow_accumulation(M, dsh)        # not a D8 forest, solve the general system
+
+    receiver = np.full(n, -1, dtype='i8')
+    receiver[rows] = receivers
+    a = _accumulate(receiver, np.ones(n, 'd'))
+    if a is None:
+        return _solve_flow_accumulation(M, dsh)        # cells on a loop never become sources
+    return a.reshape(dsh, order='F')
+
+
+def _accumulate(receiver, a):
+    # Adds the value a of every cell to all cells downstream of it, following receiver (-1 for none).
+    # Returns a, or None if some cells are on a loop.
+    n = len(receiver)
+    donors = np.bincount(receiver[receiver >= 0], minlength=n).astype('i8')
+    sweep = _sweep_kernel()
+    if sweep is not None:
+        swept = sweep(receiver, donors, a)
+    else:
+        front = np.flatnonzero(donors == 0)
+        swept = 0
+        while len(front):
+            swept += len(front)
+            front = front[receiver[front] >= 0]
+            r = receiver[front]
+            np.add.at(a, r, a[front])
+            np.subtract.at(donors, r, 1)
+            front = np.unique(r[donors[r] == 0])
+    return a if swept == n else None
+
+
+_kernels = {}
+
+def _sweep_kernel():
+    # Compiles the downstream sweep with numba, if it is available. Returns None otherwise.
+    if 'sweep' not in _kernels:
+        try:
+            numba = __import__('numba')
+        except ImportError:
+            _kernels['sweep'] = None
+            return None
+
+        @numba.njit(nogil=True)
+        def sweep(receiver, donors, a):
+            # each cell is visited once, after all of its donors; returns the number of cells visited
+            n = receiver.shape[0]
+            stack = np.empty(n, dtype=np.int64)
+            top = 0
+            for i in range(n):
+                if donors[i] == 0:
+                    stack[top] = i
+                    top += 1
+            swept = 0
+            while top > 0:
+                top -= 1
+                i = stack[top]
+                swept += 1
+                r = receiver[i]
+                if r >= 0:
+                    a[r] += a[i]
+                    donors[r] -= 1
+                    if donors[r] == 0:
+                        stack[top] = r
+                        top += 1
+            return swept
+
+        _kernels['sweep'] = sweep
+    return _kernels['sweep']
+
+
+class FlowRouter():
+    # D8 flow accumulation over a whole DEM that is processed in tiles, so that upstream areas continue
+    # across tile borders. read(row, col, rows, cols) returns a window of the DEM, with NaN for NoData.
+    # Cells drain to their steepest downhill neighbor, ties going to the first in the order of
+    # calc_d8_slopes; flow that would leave the DEM ends at its edge, and NoData cells neither drain
+    # nor receive flow, their accumulation is NaN. Each tile is read at most twice:
+    #  1. once by every tile, with a one-cell halo, for its outflows (cells that drain into another
+    #     tile) with their local accumulation, and for the outflow through which flow entering at each
+    #     of its border cells leaves it again;
+    #  2. outflows are linked through the tiles they enter into a graph no larger than the tile borders,
+    #     whose accumulation gives the inflow into each border cell;
+    #  3. once more when the tile is requested, with the accumulation seeded by its inflows.
+
+    def __init__(self, read, nRows, nCols, DX, DY, tileSize=1024):
+        self.read = read
+        self.nRows, self.nCols = int(nRows), int(nCols)
+        self.DX, self.DY = DX, DY
+        self.tileSize = int(tileSize)
+        self.inflow = None
+        self.tiles = LRUCache(16)
+        self.lock = Lock()
+
+    def accumulation(self, row, col, rows, cols):
+        # the accumulation of a window of the DEM (1 outside of it), assembled from tiles
+        with self.lock:
+            if self.inflow is None:
+                self.inflow = self._route()
+
+        T = self.tileSize
+        a = np.ones((rows, cols), 'd')
+        for i in range(max(row, 0) // T, (min(row + rows, self.nRows) - 1) // T + 1):
+            for j in range(max(col, 0) // T, (min(col + cols, self.nCols) - 1) // T + 1):
+                t = self.tiles.lookup((i, j), lambda: self._tile(i, j))
+                ra, rb = max(row, i*T), min(row + rows, i*T + t.shape[0])
+                ca, cb = max(col, j*T), min(col + cols, j*T + t.shape[1])
+                a[ra-row:rb-row, ca-col:cb-col] = t[ra-i*T:rb-i*T, ca-j*T:cb-j*T]
+        return a
+
+    def _tiles(self):
+        T = self.tileSize
+        for i in range(0, self.nRows, T):
+            for j in range(0, self.nCols, T):
+                yield i, j, min(T, self.nRows - i), min(T, self.nCols - j)
+
+    def _local(self, row, col, rows, cols, seeds=None):
+        # Returns the cell index and receiver (-1 for none) of each cell of a tile in the whole DEM
+        # (row major), its receiver within the tile, and its accumulation within the tile.
+        ra, rb = max(row - 1, 0), min(row + rows + 1, self.nRows)
+        ca, cb = max(col - 1, 0), min(col + cols + 1, self.nCols)
+        w = np.asarray(self.read(ra, ca, rb - ra, cb - ca), 'd').reshape(rb - ra, cb - ca)
+        ghost = np.pad(w, ((ra - row + 1, row + rows + 1 - rb), (ca - col + 1, col + cols + 1 - cb)), mode='edge')
+
+        slopes = calc_d8_slopes(self.DX, self.DY, ghost)
+        slopes[np.isnan(slopes)] = -np.inf                  # from or towards NoData
+        k = slopes.argmax(axis=0)
+        r = np.arange(row, row + rows)[:, None] + np.array([0, -1, -1, -1, 0, 1, 1, 1])[k]
+        c = np.arange(col, col + cols)[None, :] + np.array([1, 1, 0, -1, -1, -1, 0, 1])[k]
+        inside = (slopes.max(axis=0) > 0) & (r >= 0) & (r < self.nRows) & (c >= 0) & (c < self.nCols)
+        receiver = np.where(inside, r * self.nCols + c, -1).ravel()
+        within = inside & (r >= row) & (r < row + rows) & (c >= col) & (c < col + cols)
+        local = np.where(within, (r - row) * cols + (c - col), -1).ravel()
+
+        cells = (np.arange(row, row + rows)[:, None] * self.nCols + np.arange(col, col + cols)).ravel()
+        a = np.ones(rows * cols, 'd')
+        if seeds is not None:
+            ids, amounts = seeds
+            a[((ids // self.nCols) - row) * cols + (ids % self.nCols) - col] += amounts
+        a = _accumulate(local, a)
+        a[np.isnan(ghost[1:-1, 1:-1]).ravel()] = np.nan
+        return cells, receiver, local, a
+
+    def _route(self):
+        # Phase 1 and 2: returns the cells that receive flow from other tiles, and how much.
+        outflow, total, target, entry, exit = [], [], [], [], []
+        for row, col, rows, cols in self._tiles():
+            cells, receiver, local, a = self._local(row, col, rows, cols)
+            out = (local < 0) & (receiver >= 0)
+            outflow.append(cells[out])
+            total.append(a[out])
+            target.append(receiver[out])
+
+            # follow every cell down to the last cell of the tile on its path (pointer doubling)
+            last = np.where(local >= 0, local, np.arange(len(local)))
+            while True:
+                further = last[last]
+                if np.array_equal(further, last):
+                    break
+                last = further
+            border = np.zeros((rows, cols), bool)
+            border[[0, -1], :] = border[:, [0, -1]] = True
+            border = np.flatnonzero(border)
+            entry.append(cells[border])
+            exit.append(np.where(out[last[border]], cells[last[border]], -1))
+
+        outflow, total, target = np.concatenate(outflow), np.concatenate(total), np.concatenate(target)
+        entry, exit = np.concatenate(entry), np.concatenate(exit)
+
+        # each outflow drains into the outflow through which its receiver's tile is left, if any
+        order = np.argsort(entry)
+        following = exit[order[np.searchsorted(entry, target, sorter=order)]]
+        order = np.argsort(outflow)
+        receiver = np.where(following >= 0,
+                            order[np.searchsorted(outflow, following, sorter=order).clip(0, len(order) - 1)], -1)
+        total = _accumulate(receiver, total)
+
+        cells, index = np.unique(target, return_inverse=True)
+        return cells, np.bincount(index.ravel(), weights=total, minlength=len(cells))
+
+    def _tile(self, i, j):
+        # Phase 3: the accumulation of a tile, seeded with the flow it receives from other tiles
+        T = self.tileSize
+        row, col = i * T, j * T
+        rows, cols = min(T, self.nRows - row), min(T, self.nCols - col)
+        cells, amounts = self.inflow
+        r, c = cells // self.nCols, cells % self.nCols
+        mine = (r >= row) & (r < row + rows) & (c >= col) & (c < col + cols)
+        a = self._local(row, col, rows, cols, (cells[mine], amounts[mine]))[3]
+        return a.reshape(rows, cols)
+
+
+def _arcpy_reader(path, extent, cx, cy):
+    # reads windows (row, col, rows, cols) of a raster dataset, counted from its top-left corner,
+    # as float64 with NaN for NoData
+    arcpy = __import__('arcpy')
+    nodata = arcpy.Raster(path).noDataValue
+
+    def read(row, col, rows, cols):
+        corner = arcpy.Point(extent[0] + col * cx, extent[3] - (row + rows) * cy)
+        w = arcpy.RasterToNumPyArray(path, corner, cols, rows).astype('d')
+        if nodata is not None:
+            w[w == nodata] = np.nan
+        return w
+    return read
+
+
+def _solve_flow_accumulation(M, dsh):
     nc = M.shape[1]
     I = sp.eye(M.shape[0], M.shape[1])
     B = I - M.transpose()
@@ -1,6 +1,6 @@
-import pandas as pd
 from sklearn.ensemble import GradientBoostingClassifier
 import numpy as np
+from mlutils import trainModel, validPixels, classifyPixels, RemoteModel
 
 '''
 Gradient Boosting for classification.
@@ -24,9 +24,13 @@ class BoostedClassifier():
                            'implemented as a Python Raster Function'
 
         # inputs as string, but eventually will be numpy arrays
-        self.df = None
         self.datafile = None
+        self.model = None
         self.threshold = 0.5
+        self.threads = 1
+        self.unique = False
+        self.remember = False
+        self.server = False
 
 
     def getParameterInfo(self):
@@ -46,86 +50,106 @@ class BoostedClassifier():
                 'required': True,
                 'displayName': 'Training data CSV filepath',
                 'description': 'Full filepath directory to training data CSV. '
-                               'Internally this will load from disk and be converted to a pandas dataframe.'
+                               'Internally this will load from disk and be converted to a pandas dataframe. '
+                               'A .npz file made from the CSV with mlutils.convertTrainingData is mapped '
+                               'from disk without parsing.'
+            },
+            {
+                'name': 'threads',
+                'dataType': 'numeric',
+                'value': 1,
+                'required': False,
+                'displayName': 'Number of threads',
+                'description': 'The number of threads on which chunks of valid pixels are classified in parallel.'
+            },
+            {
+                'name': 'unique',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': 'Unique Spectra',
+                'description': 'Classify each distinct combination of band values in a tile once. '
+                               'Suited to integer imagery with repeated values.'
+            },
+            {
+                'name': 'remember',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': 'Remember Spectra',
+                'description': 'With Unique Spectra, also keep the results of recent combinations of band values '
+                               'for the next tiles. Helps only if most combinations repeat across tiles.'
+            },
+            {
+                'name': 'server',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': 'Use Model Server',
+                'description': 'Classify pixels with the model held by the server on this machine '
+                               '(started with: python mlutils.py --serve followed by the training files), shared '
+                               'by all workers. The model is fitted in this process if no server is running '
+                               'or it does not serve the training file.'
             }
         ]
 
     def getConfiguration(self, **scalars):
         return {
             'inheritProperties': 1 | 2 | 4 | 8,     # inherit all from the raster
-            'invalidateProperties': 2 | 4 | 8       # reset stats, histogram, key properties
+            'invalidateProperties': 2 | 4 | 8,      # reset stats, histogram, key properties
+            'inputMask': True                       # need raster mask of all input rasters in .updatePixels().
         }
 
     def updateRasterInfo(self, **kwargs):
 
         # convert filepath string input param to numpy array
         self.datafile = str(kwargs['training_data_from_file'])
+        self.threads = int(kwargs.get('threads') or 1)
+        self.unique = bool(kwargs.get('unique', False))
+        self.remember = bool(kwargs.get('remember', False))
+        self.server = bool(kwargs.get('server', False))
         #self.threshold = float(kwargs['threshold'])
 
+        # Fit (once per training set and worker) GradientBoostingClassifier
+        # Recommend trying different values for:
+        #  - n_estimators
+        #  - learning_rate
+        #  - max_depth
+        #  - random_state
+        params = dict(n_estimators=100, learning_rate=1.0, max_depth=3, random_state=0)
+        self.model = None
+        if self.server:
+            try:
+                self.model = RemoteModel(self.datafile, GradientBoostingClassifier, **params)
+            except OSError:
+                pass                                        # no model server is running, fit in this process
+        if self.model is None:
+            self.model, _ = trainModel(self.datafile, GradientBoostingClassifier, **params)
+
+        # one band for the predicted class, followed by one band of probabilities per class
         kwargs['output_info']['pixelType'] = 'f4'
         kwargs['output_info']['histogram'] = ()
         kwargs['output_info']['statistics'] = ()
-        kwargs['output_info']['bandCount'] = 3
+        kwargs['output_info']['bandCount'] = 1 + len(self.model.classes_)
 
         return kwargs
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
 
-
-        self.df = pd.read_csv(self.datafile)
-
-        try:
-            fields_to_drop = ['OBJECTID', 'LOCATION_X', 'LOCATION_Y']
-            self.df.drop(fields_to_drop, axis=1, inplace=True)
-        except:
-            pass
-
-        y_val = 'VarToPredict'
-        x_train = self.df.loc[:, self.df.columns != y_val]
-        y_train = self.df[y_val]
-        x_train.fillna(0, inplace=True)
-        y_train.fillna(0, inplace=True)
-
-        # Initialize RandomForestClassifier
-        # Recommend trying different values for:
-        #  - n_estimators
-        #  - learning_rate
-        #  - max_depth
-        #  - random_state
-        regr1 = GradientBoostingClassifier(n_estimators=100, learning_rate=1.0,
-                                        max_depth=3, random_state=0)
-        regr1.fit(x_train, y_train)
-
         pix_blocks = pixelBlocks['rasters_pixels']
         pix_array = np.asarray(pix_blocks)
-        pix_array = np.squeeze(pix_array)
-
-        pixels_reshaped = pix_array.reshape(pix_array.shape[0], -1).transpose()
-
-        # Run RandomForestRegressor
-        pred = regr1.predict(pixels_reshaped)
-        pred_proba = regr1.predict_proba(pixels_reshaped)
-
-        res = np.hstack([np.expand_dims(pred, 1), pred_proba])
-
-        #res = pred.reshape((pix_array.shape[1], pix_array.shape[2]))
-        res_reshape = np.reshape(
-            res.transpose(),
-            (3, pix_array.shape[1], pix_array.shape[2])
-        )
-
-        res_reshape[res_reshape <= self.threshold] = 0.0
-
-        #res[res <= self.threshold] = 0
-        # remember that self.n_neighbors is the desired out band count
-        #res = np.zeros(
-        #    (pix_array.shape[1], pix_array.shape[2])
-        #)
-
-        pixelBlocks['output_pixels'] = res_reshape.astype(
-            props['pixelType'],
-            copy=True
-        )
+        pix_array = pix_array.reshape((-1,) + pix_array.shape[-2:])
+
+        # Run the ensemble once for the class and its probabilities,
+        # only on pixels that are valid in all input rasters
+        valid = validPixels(pixelBlocks.get('rasters_mask'))
+        res = classifyPixels(self.model, pix_array, valid, threads=self.threads, unique=self.unique,
+                             remember=self.remember)
+        res[res <= self.threshold] = 0
+
+        pixelBlocks['output_pixels'] = res.astype(props['pixelType'], copy=False)
+        if valid is not None:
+            pixelBlocks['output_mask'] = np.broadcast_to(valid, res.shape).astype('u1')
 
         return pixelBlocks
 
@@ -1,6 +1,5 @@
-import pandas as pd
 import numpy as np
-from sklearn.neighbors import KNeighborsClassifier
+from mlutils import neighborIndex, voteNeighbors, validPixels, predictPixels
 
 
 '''
@@ -10,6 +9,7 @@ each pixel.
 
 http://scikit-learn.org/stable/documentation.html
 http://scikit-learn.org/stable/modules/generated/sklearn.neighbors.NearestNeighbors.html#sklearn.neighbors.NearestNeighbors
+http://scikit-learn.org/stable/modules/generated/sklearn.neighbors.KDTree.html
 https://docs.scipy.org/doc/numpy/reference/generated/numpy.loadtxt.html#numpy.loadtxt
 '''
 
@@ -27,6 +27,18 @@ class KNNClassifier():
         # The inputs is a string
         self.training_data_from_file = None
 
+        # The number of threads on which pixels are classified
+        self.threads = 1
+
+        # Whether each distinct pixel vector is classified only once
+        self.unique = False
+        self.remember = False
+
+        # The KD-tree over the training data, the classes, and the class of each training sample
+        self.tree = None
+        self.classes = None
+        self.codes = None
+
     def getParameterInfo(self):
         return [
             {
@@ -52,19 +64,51 @@ class KNNClassifier():
                 'required': True,
                 'displayName': 'Training data CSV filepath',
                 'description': 'Full filepath directory to training data CSV. '
-                               'Internally this will load from disk and be converted to a pandas dataframe.'
+                               'Internally this will load from disk and be converted to a pandas dataframe. '
+                               'A .npz file made from the CSV with mlutils.convertTrainingData is mapped '
+                               'from disk without parsing.'
+            },
+            {
+                'name': 'threads',
+                'dataType': 'numeric',
+                'value': 1,
+                'required': False,
+                'displayName': 'Number of threads',
+                'description': 'The number of threads on which chunks of valid pixels are classified in parallel.'
+            },
+            {
+                'name': 'unique',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': 'Unique Spectra',
+                'description': 'Classify each distinct combination of band values in a tile once. '
+                               'Suited to integer imagery with repeated values.'
+            },
+            {
+                'name': 'remember',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': 'Remember Spectra',
+                'description': 'With Unique Spectra, also keep the results of recent combinations of band values '
+                               'for the next tiles. Helps only if most combinations repeat across tiles.'
             }
         ]
 
     def getConfiguration(self, **scalars):
         return {
             'inheritProperties': 1 | 2 | 4 | 8,     # inherit all from the raster
-            'invalidateProperties': 2 | 4 | 8       # reset stats, histogram, key properties
+            'invalidateProperties': 2 | 4 | 8,      # reset stats, histogram, key properties
+            'inputMask': True                       # need raster mask of all input rasters in .updatePixels().
         }
 
     def updateRasterInfo(self, **kwargs):
         self.n_neighbors = int(kwargs['n_neighbors'])
         self.datafile = str(kwargs['training_data_from_file'])
+        self.threads = int(kwargs.get('threads') or 1)
+        self.unique = bool(kwargs.get('unique', False))
+        self.remember = bool(kwargs.get('remember', False))
 
         # Number of output bands:
         # There should be one band for each neighbor calculated
@@ -76,54 +120,40 @@ class KNNClassifier():
         kwargs['output_info']['histogram'] = ()
         kwargs['output_info']['bandCount'] = 1
 
+        # Build a KD-tree over the environmental variables in the CSV file (once per training set;
+        # the tree is saved to disk and memory-mapped read-only by every worker process)
+        self.tree, y_train = neighborIndex(self.datafile)
+        self.classes, self.codes = np.unique(y_train, return_inverse=True)
+
         return kwargs
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
 
-        # Read the input CSV file into a dataframe
-        self.df = pd.read_csv(self.datafile)#(datafile)
-
-        # Drop the fields that are not involved in predicting or mapping the values.
-        # These fields will generally be things like "OBJECTID".
-        fields_to_drop = ['OBJECTID', 'LOCATION_X', 'LOCATION_Y'] # Fields that aren't used in the analysis
-        self.df.drop(fields_to_drop, axis=1, inplace=True)
-
-        # Separate dataframe into training environmental variables and observed values.
-        # The environmental values, x_train, are used to train the model
-        # We are trying to map\predict the y_train value
-        y_val =  'VarToPredict' # The value that you probably want to predict
-        x_train = self.df.loc[:, self.df.columns != y_val]
-        y_train = self.df[y_val]
-
-        # The model won't work if there is missing or null data.
-        # Fill null values with 0 (or some other value)
-        x_train.fillna(0, inplace=True)
-        y_train.fillna(0, inplace=True)
-
         # Read pixel blocks
         pix_blocks = pixelBlocks['rasters_pixels']
 
         # Convert pixel blocks to numpy array
         pix_array = np.asarray(pix_blocks)
 
-        # Remove any extra indices
-        pix_array = np.squeeze(pix_array)
+        # Stack the bands of all rasters as predictor variables
+        pix_array = pix_array.reshape((-1,) + pix_array.shape[-2:])
 
-        # Reshape the pixels into a 2D array that is number of pixels x number of predictor variables
-        pixels_reshaped = pix_array.reshape(pix_array.shape[0], -1).transpose()
+        # Only pixels that are valid in all input rasters are classified
+        valid = validPixels(pixelBlocks.get('rasters_mask'))
 
-        # Classify each point using the k-neighbors classifier
-        knn = KNeighborsClassifier(n_neighbors=self.n_neighbors)
-        pred = knn.fit(x_train, y_train).predict(pixels_reshaped)
+        # Classify each point by a majority vote of its k nearest neighbors,
+        # in chunks of pixels that are number of pixels x number of predictor variables
+        def predict(x):
+            ind = self.tree.query(x, k=self.n_neighbors, return_distance=False)
+            return self.classes[voteNeighbors(ind, self.codes, len(self.classes))]
 
-        # Reshape into a 2D array
-        res = pred.reshape((pix_array.shape[1], pix_array.shape[2]))
+        res = predictPixels(predict, pix_array, valid, threads=self.threads, unique=self.unique,
+                            cacheKey=('vote', self.tree, self.n_neighbors) if self.unique and self.remember else None)[0]
 
         # Write output pixels
-        pixelBlocks['output_pixels'] = res.astype(
-            props['pixelType'],
-            copy=True
-        )
+        pixelBlocks['output_pixels'] = res.astype(props['pixelType'], copy=False)
+        if valid is not None:
+            pixelBlocks['output_mask'] = valid.astype('u1')
 
         return pixelBlocks
 
@@ -1,7 +1,6 @@
 import numpy as np
-import datetime
-from datetime import timedelta
 import sys
+from utils import TimeIndex
 
 
 #import os
@@ -24,7 +23,8 @@ class LandsatPixelPercentile():
         self.description = 'This function creates a synthetic Landsat image given a day of year range' \
             'and the percentile of the pixel that we want to calculate.'
 
-        self.times = []
+        self.times = None
+        self.indices = None
         self.predict_month = None
 
     def getParameterInfo(self):
@@ -106,7 +106,7 @@ class LandsatPixelPercentile():
         kwargs['output_info']['statistics'] = ()            # outStatsTuple
         #kwargs['output_info']['bandCount'] = self.outBandCount   # number of output bands.
 
-        self.times = kwargs['rasters_keyMetadata']
+        self.times = TimeIndex(kwargs['rasters_keyMetadata'])
 
         self.start_day = int(kwargs['start_day'])
         self.start_year = int(kwargs['start_year'])
@@ -125,6 +125,10 @@ class LandsatPixelPercentile():
             self.filter = LANDSAT_CLEAR_PIX_VALS
             self.qa_band_num = 7
 
+        # scenes within the year and day-of-year window are the same for every pixel block
+        self.indices = self.times.filter(years=(self.start_year, self.end_year),
+                                         days=(self.start_day, self.end_day))
+
         return kwargs
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
@@ -139,31 +143,13 @@ class LandsatPixelPercentile():
         #file = open(filename,"w")
         #file.write("File Open.\n")
 
-        t_vals = [j['acquisitiondate'] for j in self.times]
-
-        #pickle_filename = os.path.join(debug_logs_directory, fname)
-        #pickle.dump(t_vals, open(pickle_filename[:-4]+'pix_time.p',"wb"))
-
-        #file.write(str(len(pix_time))+ "\n")
-
         pix_blocks = pixelBlocks['rasters_pixels']
         pix_array = np.asarray(pix_blocks)
 
         #pickle_filename = os.path.join(debug_logs_directory, fname)
         #pickle.dump(pix_blocks, open(pickle_filename[:-4]+'pix_blocks.p',"wb"))
 
-        base_date = datetime.datetime(1900, 1, 1) - datetime.timedelta(days=2)
-
-        year_doy = np.zeros((len(t_vals), 2))
-        year_doy[:, 0] = [(base_date + datetime.timedelta(days=t)).year for t in t_vals]
-        year_doy[:, 1] = [(base_date + datetime.timedelta(days=t)).timetuple().tm_yday for t in t_vals]
-
-        filtered_year_doy = [[idx, ym] for idx, ym in enumerate(year_doy) if
-                             ((ym[0] >=self.start_year and ym[0]<=self.end_year) and (ym[1] >= self.start_day and ym[1] <= self.end_day))]
-
-        year_doy_filtered_indices = [idx[0] for idx in filtered_year_doy]
-        year_doy_filtered = [doy[1] for doy in filtered_year_doy]
-        pix_array_filtered = pix_array[year_doy_filtered_indices, :, :, :]
+        pix_array_filtered = pix_array[self.indices, :, :, :]
 
         pix_array_dim = pix_array_filtered.shape
         num_bands = pix_array_dim[1] - 1
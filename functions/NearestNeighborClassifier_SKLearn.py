@@ -1,6 +1,5 @@
-import pandas as pd
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
+from mlutils import neighborIndex, validPixels, predictPixels
 
 
 '''
@@ -9,6 +8,7 @@ input values to the resulting neighbor array.
 
 http://scikit-learn.org/stable/documentation.html
 http://scikit-learn.org/stable/modules/generated/sklearn.neighbors.NearestNeighbors.html#sklearn.neighbors.NearestNeighbors
+http://scikit-learn.org/stable/modules/generated/sklearn.neighbors.KDTree.html
 https://docs.scipy.org/doc/numpy/reference/generated/numpy.loadtxt.html#numpy.loadtxt
 '''
 
@@ -26,6 +26,17 @@ class NearestNeighborsClassifier():
         # The inputs is a string
         self.training_data_from_file = None
 
+        # The number of threads on which pixels are classified
+        self.threads = 1
+
+        # Whether each distinct pixel vector is classified only once
+        self.unique = False
+        self.remember = False
+
+        # The KD-tree over the training data, and the observed value of each training sample
+        self.tree = None
+        self.y_train = None
+
     def getParameterInfo(self):
         return [
             {
@@ -51,19 +62,51 @@ class NearestNeighborsClassifier():
                 'required': True,
                 'displayName': 'Training data CSV filepath',
                 'description': 'Full filepath directory to training data CSV. '
-                               'Internally this will load from disk and be converted to a numpy array.'
+                               'Internally this will load from disk and be converted to a numpy array. '
+                               'A .npz file made from the CSV with mlutils.convertTrainingData is mapped '
+                               'from disk without parsing.'
+            },
+            {
+                'name': 'threads',
+                'dataType': 'numeric',
+                'value': 1,
+                'required': False,
+                'displayName': 'Number of threads',
+                'description': 'The number of threads on which chunks of valid pixels are classified in parallel.'
+            },
+            {
+                'name': 'unique',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': 'Unique Spectra',
+                'description': 'Classify each distinct combination of band values in a tile once. '
+                               'Suited to integer imagery with repeated values.'
+            },
+            {
+                'name': 'remember',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': 'Remember Spectra',
+                'description': 'With Unique Spectra, also keep the results of recent combinations of band values '
+                               'for the next tiles. Helps only if most combinations repeat across tiles.'
             }
         ]
 
     def getConfiguration(self, **scalars):
         return {
             'inheritProperties': 1 | 2 | 4 | 8,     # inherit all from the raster
-            'invalidateProperties': 2 | 4 | 8       # reset stats, histogram, key properties
+            'invalidateProperties': 2 | 4 | 8,      # reset stats, histogram, key properties
+            'inputMask': True                       # need raster mask of all input rasters in .updatePixels().
         }
 
     def updateRasterInfo(self, **kwargs):
         self.n_neighbors = int(kwargs['n_neighbors'])
         self.datafile = str(kwargs['training_data_from_file'])
+        self.threads = int(kwargs.get('threads') or 1)
+        self.unique = bool(kwargs.get('unique', False))
+        self.remember = bool(kwargs.get('remember', False))
 
         # Number of output bands:
         # There should be one band for each neighbor calculated
@@ -84,84 +127,48 @@ class NearestNeighborsClassifier():
         # repeat stats for all output raster bands
         kwargs['output_info']['statistics'] = tuple(outStats for i in range(self.n_neighbors))
 
+        # Build a KD-tree over the environmental variables in the CSV file (once per training set;
+        # the tree is saved to disk and memory-mapped read-only by every worker process)
+        # y_train holds the observed values we are trying to map\predict
+        self.tree, self.y_train = neighborIndex(self.datafile)
 
         return kwargs
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
 
-        # Read the input CSV file into a dataframe
-        self.df = pd.read_csv(self.datafile)#(datafile)
-
-        # Drop the fields that are not involved in predicting or mapping the values.
-        # These fields will generally be things like "OBJECTID".
-        fields_to_drop = ['OBJECTID', 'LOCATION_X', 'LOCATION_Y'] # Fields that aren't used in the analysis
-        self.df.drop(fields_to_drop, axis=1, inplace=True)
-
-        # Separate dataframe into training environmental variables and observed values.
-        # The environmental values, x_train, are used to train the model
-        # We are trying to map\predict the y_train value
-        y_val =  'VarToPredict' # The value that you probably want to predict
-        x_train = self.df.loc[:, self.df.columns != y_val]
-        y_train = self.df[y_val]
-
-        # The model won't work if there is missing or null data.
-        # Fill null values with 0 (or some other value)
-        x_train.fillna(0, inplace=True)
-        y_train.fillna(0, inplace=True)
-
         # Read pixel blocks
         pix_blocks = pixelBlocks['rasters_pixels']
 
         # Convert pixel blocks to numpy array
         pix_array = np.asarray(pix_blocks)
 
-        # Remove any extra indices
-        pix_array = np.squeeze(pix_array)
-
-        # Reshape the pixels into a 2D array that is number of pixels x number of predictor variables
-        pixels_reshaped = pix_array.reshape(pix_array.shape[0], -1).transpose()
-
-        # Initialize an array of zeros that will be used to output the results
-        # The array will have the same number of bands as neighbors
-        res = np.zeros(
-            (self.n_neighbors, pix_array.shape[1], pix_array.shape[2])
-        )
+        # Stack the bands of all rasters as predictor variables
+        pix_array = pix_array.reshape((-1,) + pix_array.shape[-2:])
 
-        # Create an instance of the nearest neighbor classifier
-        # Fit the model using x_train
-        nn_classifier = NearestNeighbors(
-            n_neighbors=self.n_neighbors,
-            metric='euclidean'
-        ).fit(x_train)
+        # Only pixels that are valid in all input rasters are classified
+        valid = validPixels(pixelBlocks.get('rasters_mask'))
 
         # Finds the nearest neighbors of a point
         # (i.e. get the neighbors for each prediction)
         # ind are the indices of the nearest points in the population matrix
-        ind = nn_classifier.kneighbors(
-            pixels_reshaped,
-            n_neighbors=self.n_neighbors,
-            return_distance=False
-        )
-
-        # Output the neighbor IDs
-        # construct array corresponding to data entries in ind as y_train[ind]
-        # reshape each neighbor array to image dimensions (NN bands)
-        reshaped_res = y_train.values[ind]
-        nn_array = np.reshape(
-            reshaped_res.transpose(),
-            (self.n_neighbors, pix_array.shape[1], pix_array.shape[2])
-        )
-
-        # Fill the zeros array with the results
-        # Remember that self.n_neighbors is the desired out band count
-        for i in range(0, self.n_neighbors):
-            res[i, :, :] = nn_array[i, :, :]
+        # Output the neighbor IDs: construct array corresponding to data entries in ind as y_train[ind]
+        def neighbors(x):
+            ind = self.tree.query(
+                x,
+                k=self.n_neighbors,
+                return_distance=False
+            )
+            return self.y_train[ind]
+
+        # Run the search in chunks of pixels that are number of pixels x number of predictor variables
+        # The result has the same number of bands as neighbors (NN bands)
+        res = predictPixels(neighbors, pix_array, valid, self.n_neighbors, threads=self.threads, unique=self.unique,
+                            cacheKey=('neighbors', self.tree, self.n_neighbors) if self.unique and self.remember else None)
 
         # Write output pixels
-        pixelBlocks['output_pixels'] = res.astype(
-            props['pixelType'],
-            copy=True
-        )
+        pixelBlocks['output_pixels'] = res.astype(props['pixelType'], copy=False)
+        if valid is not None:
+            pixelBlocks['output_mask'] = np.broadcast_to(valid, res.shape).astype('u1')
 
         return pixelBlocks
 
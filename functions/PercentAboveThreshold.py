@@ -1,6 +1,6 @@
 import numpy as np
-from datetime import timedelta
 import datetime
+from utils import TimeIndex
 #import sys
 
 #import os
@@ -17,7 +17,8 @@ class PercentAboveThreshold():
                            'The raster function can be applied to a time-enabled stack of rasters in ' \
                            'a mosaic dataset.'
 
-        self.times = []
+        self.times = None
+        self.indices = None
         self.start_year = None
         self.end_year = None
         self.threshold = 50
@@ -77,11 +78,16 @@ class PercentAboveThreshold():
         #kwargs['output_info'][
         #    'bandCount'] = outBandCount  # number of output bands. 7 time bands, 3 TC bands, creates 21 bands
 
-        self.times = kwargs['rasters_keyMetadata']
+        self.times = TimeIndex(kwargs['rasters_keyMetadata'])
         self.start_date = kwargs['start_date']
         self.end_date = kwargs['end_date']
         self.threshold = int(kwargs['threshold'])
 
+        # rasters within the analysis window are the same for every pixel block
+        start_datetime = datetime.datetime.strptime(self.start_date, '%m/%d/%Y %H:%M:%S')  # %p')
+        end_datetime = datetime.datetime.strptime(self.end_date, '%m/%d/%Y %H:%M:%S')  # %p')
+        self.indices = self.times.window(start_datetime, end_datetime)
+
         return kwargs
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
@@ -95,9 +101,6 @@ class PercentAboveThreshold():
         #file = open(filename,"w")
         #file.write("File Open.\n")
 
-        pix_time = [j['acquisitiondate'] for j in self.times]
-
-
         #pickle_filename = os.path.join(debug_logs_directory, fname)
         #pickle.dump(pix_time, open(pickle_filename[:-4]+'pix_time.p',"wb"))
 
@@ -121,20 +124,7 @@ class PercentAboveThreshold():
         #vals_above_thresh_count = np.size(np.where(pix_as_array <= self.threshold))
         #outBlock = np.ones((num_squares_x, num_squares_y)) * (vals_above_thresh_count / total_count) * 100
 
-        t_array = []
-        ind_array = []
-        start_date = self.start_date #"1/1/2019 12:30:00"
-        end_date = self.end_date #"7/7/2019 12:30:00"
-        start_datetime = datetime.datetime.strptime(start_date, '%m/%d/%Y %H:%M:%S')  # %p')
-        end_datetime = datetime.datetime.strptime(end_date, '%m/%d/%Y %H:%M:%S')  # %p')
-        for ind, time in enumerate(pix_time):
-            temp_t = datetime.datetime(1900, 1, 1) + timedelta(time - 2)
-            if temp_t >= start_datetime and temp_t <= end_datetime:
-                t_array.append(temp_t)
-                ind_array.append(ind)
-
-        #time_within = [pix_time[x] for x in ind_array]
-        pix_array_within = pix_array[ind_array, :, :, :]
+        pix_array_within = pix_array[self.indices, :, :, :]
 
         #threshold = 50
         pix_as_array = np.reshape(pix_array_within, -1)
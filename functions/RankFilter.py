@@ -1,4 +1,5 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from skimage.transform import resize
 from skimage.util import view_as_blocks
 from skimage.filters import rank
@@ -15,6 +16,11 @@ class RankFilter():
         self.window = None
         self.trace = Trace()
         self.padding = 0
+        self.allBands = False
+        self.kernel = None
+        self.size = 3
+        self.percentile = 50.
+        self.threads = 1
 
     def getParameterInfo(self):
         return [
@@ -32,7 +38,7 @@ class RankFilter():
                 'value': 'Mean',
                 'required': False,
                 'displayName': "Measure",
-                'domain': ('Minimum', 'Maximum', 'Mean', 'Bilateral Mean', 'Median', 
+                'domain': ('Minimum', 'Maximum', 'Mean', 'Bilateral Mean', 'Median', 'Percentile',
                            'Sum', 'Entropy', 'Threshold', 'Autolevel'),
                 'description': ("The measure represented by an ouput pixel " 
                                 "computed over a sliding window of input pixels.")
@@ -45,6 +51,15 @@ class RankFilter():
                 'displayName': "Window Size",
                 'description': ("The width of the sliding window or kernel (in pixels).")
             },
+            {
+                'name': 'percentile',
+                'dataType': 'numeric',
+                'value': 50,
+                'required': False,
+                'displayName': "Percentile",
+                'description': ("The percentile (between 0 and 100) of the pixels in the window that is output "
+                                "by the Percentile measure.")
+            },
             {
                 'name': 'res',
                 'dataType': 'string',
@@ -56,6 +71,24 @@ class RankFilter():
                                 "Choose between processing input pixels at resampled display/request resolution "
                                 "or in the original/raster resolution.")
             },
+            {
+                'name': 'bands',
+                'dataType': 'string',
+                'value': 'First',
+                'required': False,
+                'displayName': "Output Bands",
+                'domain': ('First', 'All'),
+                'description': ("Filter only the first band of the input raster, or all of its bands. "
+                                "Bands that are not output are not filtered.")
+            },
+            {
+                'name': 'threads',
+                'dataType': 'numeric',
+                'value': 1,
+                'required': False,
+                'displayName': "Number of threads",
+                'description': ("The number of threads on which output bands are filtered in parallel.")
+            },
         ]
 
     def getConfiguration(self, **scalars):
@@ -76,8 +109,21 @@ class RankFilter():
         kwargs['output_info']['statistics'] = ()
         kwargs['output_info']['histogram'] = ()
 
-        self.window = square(int(kwargs.get('size', 3)))
+        self.size = int(kwargs.get('size', 3))
+        self.percentile = float(kwargs.get('percentile', 50.))
+        self.window = square(self.size)
+        self.allBands = str(kwargs.get('bands', 'First')).lower() == 'all'
+        self.threads = int(kwargs.get('threads') or 1)
+        kwargs['output_info']['bandCount'] = kwargs['raster_info']['bandCount'] if self.allBands else 1
         m = kwargs.get('measure', 'Mean').lower()
+
+        # these measures have kernels that cost the same per pixel whatever the window size,
+        # and work on float pixels without converting them to integers
+        self.kernel = {'minimum': minimumFilter, 'maximum': maximumFilter,
+                       'sum': sumFilter, 'mean': meanFilter,
+                       'median': lambda x, size, mask: percentileFilter(x, size, mask, 50.),
+                       'percentile': lambda x, size, mask: percentileFilter(x, size, mask, self.percentile)}.get(m)
+
         if m == 'minimum':
             self.func = rank.minimum
         elif m == 'maximum':
@@ -102,12 +148,25 @@ class RankFilter():
         p = pixelBlocks['raster_pixels']
         m = pixelBlocks['raster_mask']
 
-        q = np.empty(p.shape)
-        for b in range(p.shape[0]): 
-            q[b] = self.func(p[b], selem=self.window, mask=m[b])
-
         d = self.padding
-        pixelBlocks['output_pixels'] = q[0][d:-d, d:-d].astype(props['pixelType'], copy=False)
+        rows, cols = slice(d, p.shape[-2] - d), slice(d, p.shape[-1] - d)
+
+        # filter only the bands that are output, on several threads if asked, in the type that the filter returns
+        def filterBand(b):
+            if self.kernel is not None:
+                return self.kernel(p[b], self.size, m[b])[:rows.stop - d, :cols.stop - d]
+            return self.func(p[b], self.window, mask=m[b])[rows, cols]
+
+        bands = range(p.shape[0]) if self.allBands else range(1)
+        if self.threads > 1 and len(bands) > 1:
+            with ThreadPoolExecutor(min(len(bands), self.threads)) as executor:
+                q = np.stack(list(executor.map(filterBand, bands)))
+        elif len(bands) > 1:
+            q = np.stack([filterBand(b) for b in bands])
+        else:
+            q = filterBand(0)
+
+        pixelBlocks['output_pixels'] = q.astype(props['pixelType'], copy=False)
         return pixelBlocks
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
@@ -116,6 +175,248 @@ class RankFilter():
         return keyMetadata
 
 
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
+
+# levels of the histograms of the percentile filter, and of the quantile bins of float pixels
+histogramBins = 4096
+
+# Kernels over square windows of size pixels. Each returns the measure of every window that lies
+# entirely within the block, i.e. a (rows - size + 1, cols - size + 1) array whose element [i, j]
+# belongs to the window with top-left corner [i, j]. As in skimage.filters.rank, pixels where mask
+# is 0 are left out of every window, and windows without any valid pixel are 0.
+
+def minimumFilter(pixels, size, mask=None):
+    return _extremumFilter(pixels, size, mask, np.minimum)
+
+
+def maximumFilter(pixels, size, mask=None):
+    return _extremumFilter(pixels, size, mask, np.maximum)
+
+
+def sumFilter(pixels, size, mask=None):
+    s, _ = _windowSum(pixels, size, mask)
+    return s.astype(_floatType(pixels), copy=False)
+
+
+def meanFilter(pixels, size, mask=None):
+    s, n = _windowSum(pixels, size, mask)
+    s /= np.maximum(n, 1)
+    return s.astype(_floatType(pixels), copy=False)
+
+
+def percentileFilter(pixels, size, mask=None, percentile=50.):
+    # Sliding percentile from column histograms (Perreault-Hebert): the smallest value of the window
+    # whose count of smaller or equal valid pixels exceeds percentile/100 of the valid pixels.
+    # For the median of an even count, that is the upper of the two middle values, as in rank.median.
+    # Integer pixels are exact: each distinct value is a level, and the histograms are only used when
+    # there are at most histogramBins of them, otherwise the rank filter of scikit-image finds the
+    # percentile of up to 65536 levels. Float pixels with more than histogramBins distinct values are
+    # approximate: they are mapped to quantile bins that are represented by their mean value.
+    x = np.asarray(pixels)
+    valid = np.ones(x.shape, dtype=bool) if mask is None else mask != 0
+    if x.dtype.kind == 'f':
+        valid &= ~np.isnan(x)
+    levels, values = _quantize(x, valid, histogramBins)
+    fraction = min(max(float(percentile) / 100., 0.), 1.)
+    rows, cols = x.shape[0] - size + 1, x.shape[1] - size + 1
+
+    kernel = _histogramKernel() if len(values) <= histogramBins else None
+    if kernel is not None:
+        q = np.zeros((rows, cols), dtype='i4')
+        n = np.zeros((rows, cols), dtype='i4')
+        kernel(levels, valid, size, len(values), fraction, q, n)
+    else:
+        # without numba, or with too many levels, the rank filter of scikit-image finds the percentile of the levels
+        d = size // 2
+        q = rank.percentile(levels, square(size), mask=valid, p0=fraction)[d:d + rows, d:d + cols]
+        n = _windowSum(None, size, valid)[1]
+
+    r = values[q]
+    r[n == 0] = 0
+    return r
+
+
+def _floatType(pixels):
+    # float32, unless the pixels need more precision
+    return np.result_type(pixels.dtype, np.float32)
+
+
+def _extremumFilter(pixels, size, mask, ufunc):
+    # Separable van Herk/Gil-Werman running extremum: about three comparisons per pixel and axis.
+    # Masked pixels are set to the identity of ufunc, so that they never win.
+    x = np.asarray(pixels)
+    if x.dtype.kind == 'f':
+        fill = np.inf if ufunc is np.minimum else -np.inf
+    else:
+        info = np.iinfo(x.dtype)
+        fill = info.max if ufunc is np.minimum else info.min
+    if mask is not None:
+        x = np.where(mask, x, np.array(fill, dtype=x.dtype))
+
+    r = _runningExtremum(_runningExtremum(x, size, 0, ufunc, fill), size, 1, ufunc, fill)
+    if mask is not None:
+        r[_windowSum(None, size, mask)[1] == 0] = 0
+    return r
+
+
+def _runningExtremum(x, size, axis, ufunc, fill):
+    # The extremum of each run of size elements along axis. The axis is cut into blocks of size;
+    # any window spans the tail of one block and the head of the next, whose extrema are prefix and
+    # suffix accumulations within the blocks.
+    x = np.moveaxis(x, axis, -1)
+    n = x.shape[-1]
+    m = -(-n // size)
+    padded = np.full(x.shape[:-1] + (m * size,), fill, dtype=x.dtype)
+    padded[..., :n] = x
+    blocks = padded.reshape(x.shape[:-1] + (m, size))
+    head = ufunc.accumulate(blocks, axis=-1).reshape(padded.shape)
+    tail = ufunc.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+    r = ufunc(tail[..., :n - size + 1], head[..., size - 1:n])
+    return np.moveaxis(r, -1, axis)
+
+
+def _quantize(x, valid, bins):
+    # Returns the level (uint16) of each pixel, and the value of each level. Levels are the distinct
+    # values of integer pixels, or of float pixels with at most bins distinct values. Otherwise,
+    # pixels are mapped to quantile bins: float pixels to bins of them, and integer pixels with more
+    # than 65536 distinct values to 65536.
+    v = x[valid]
+    if not len(v):
+        return np.zeros(x.shape, dtype='u2'), np.zeros(1, dtype=x.dtype)
+
+    values = np.unique(v)
+    if x.dtype.kind != 'f':
+        bins = 65536
+    if len(values) <= bins:
+        levels = np.searchsorted(values, x)
+    else:
+        edges = np.quantile(v, np.linspace(0., 1., bins + 1)[1:-1])
+        levels = np.searchsorted(edges, x, side='right')
+        counts = np.bincount(levels[valid], minlength=bins)
+        sums = np.bincount(levels[valid], weights=v, minlength=bins)
+        values = (sums / np.maximum(counts, 1)).astype(x.dtype)
+    return np.minimum(levels, len(values) - 1).astype('u2'), values
+
+
+_kernels = {}
+
+def _histogramKernel():
+    # Compiles the column-histogram percentile filter with numba, if it is available. Returns None otherwise.
+    if 'histogram' not in _kernels:
+        try:
+            numba = __import__('numba')
+        except ImportError:
+            _kernels['histogram'] = None
+            return None
+
+        @numba.njit(nogil=True)
+        def filter(levels, valid, size, bins, fraction, q, n):
+            # Every column keeps a histogram of the size pixels above the current output row, and the
+            # window's histogram slides along the row by adding one column and removing another.
+            # Histograms have coarse bins of 16 levels; a window's fine histogram is only brought up
+            # to date for the coarse bin that holds the percentile, so the cost per pixel doesn't grow
+            # with the window size.
+            rows, cols = q.shape
+            width = levels.shape[1]
+            nc = (bins + 15) >> 4
+            colFine = np.zeros((width, nc << 4), dtype=np.int32)
+            colCoarse = np.zeros((width, nc), dtype=np.int32)
+            colCount = np.zeros(width, dtype=np.int32)
+            fine = np.zeros(nc << 4, dtype=np.int32)
+            coarse = np.zeros(nc, dtype=np.int32)
+            since = np.zeros(nc, dtype=np.int64)        # window position of the last update of each fine segment
+
+            for i in range(size - 1):
+                for j in range(width):
+                    if valid[i, j]:
+                        v = levels[i, j]
+                        colFine[j, v] += 1
+                        colCoarse[j, v >> 4] += 1
+                        colCount[j] += 1
+
+            for i in range(rows):
+                for j in range(width):
+                    if i > 0 and valid[i - 1, j]:
+                        v = levels[i - 1, j]
+                        colFine[j, v] -= 1
+                        colCoarse[j, v >> 4] -= 1
+                        colCount[j] -= 1
+                    if valid[i + size - 1, j]:
+                        v = levels[i + size - 1, j]
+                        colFine[j, v] += 1
+                        colCoarse[j, v >> 4] += 1
+                        colCount[j] += 1
+
+                total = 0
+                for c in range(nc):
+                    coarse[c] = 0
+                    since[c] = -size                        # all fine segments are out of date
+                for j in range(size):
+                    total += colCount[j]
+                    for c in range(nc):
+                        coarse[c] += colCoarse[j, c]
+
+                for j in range(cols):
+                    if j > 0:
+                        total += colCount[j + size - 1] - colCount[j - 1]
+                        for c in range(nc):
+                            coarse[c] += colCoarse[j + size - 1, c] - colCoarse[j - 1, c]
+                    n[i, j] = total
+                    if total == 0:
+                        continue
+
+                    t = min(fraction * total, total - 0.5)
+                    below = 0
+                    c = 0
+                    while below + coarse[c] <= t:
+                        below += coarse[c]
+                        c += 1
+
+                    lo = c << 4
+                    if j - since[c] >= size:
+                        for k in range(lo, lo + 16):
+                            fine[k] = 0
+                        for z in range(j, j + size):
+                            for k in range(lo, lo + 16):
+                                fine[k] += colFine[z, k]
+                    else:
+                        for z in range(since[c], j):
+                            for k in range(lo, lo + 16):
+                                fine[k] += colFine[z + size, k] - colFine[z, k]
+                    since[c] = j
+
+                    k = lo
+                    while below + fine[k] <= t:
+                        below += fine[k]
+                        k += 1
+                    q[i, j] = k
+
+        _kernels['histogram'] = filter
+    return _kernels['histogram']
+
+
+def _windowSum(pixels, size, mask):
+    # Sums of the valid pixels and counts of valid pixels in each window, from cumulative sums
+    # along each axis (a separable integral image) in float64. Pixels may be None for counts only.
+    def box(x):
+        c = np.zeros((x.shape[0] + 1, x.shape[1]))
+        np.cumsum(x, axis=0, out=c[1:])
+        x = c[size:] - c[:-size]
+        c = np.zeros((x.shape[0], x.shape[1] + 1))
+        np.cumsum(x, axis=1, out=c[:, 1:])
+        return c[:, size:] - c[:, :-size]
+
+    if mask is not None:
+        n = box(mask != 0)
+    else:
+        rows, cols = np.shape(pixels)[-2:]
+        n = np.full((rows - size + 1, cols - size + 1), float(size * size))
+    if pixels is None:
+        return None, n
+    x = np.where(mask != 0, pixels, 0) if mask is not None else pixels
+    return box(x), n
+
+
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
 
 """
@@ -128,4 +429,12 @@ References:
 
     [3] Scikit-image: Image processing in Python (Rank filters).
         http://scikit-image.org/docs/dev/auto_examples/applications/plot_rank_filters.html
+
+    [4] van Herk, M., 1992. A fast algorithm for local minimum and maximum filters on rectangular
+        and octagonal kernels. Pattern Recognition Letters, 13(7), pp.517-521.
+
+    [5] Gil, J. and Werman, M., 1993. Computing 2-D min, median, and max filters.
+        IEEE Transactions on Pattern Analysis and Machine Intelligence, 15(5), pp.491-499.
+
+    [6] Crow, F.C., 1984. Summed-area tables for texture mapping. SIGGRAPH Computer Graphics, 18(3).
 """
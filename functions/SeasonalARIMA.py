@@ -2,6 +2,7 @@ import numpy as np
 import statsmodels.api as sm
 import pandas as pd
 import datetime
+from utils import TimeIndex
 
 # For Debugging
 import os
@@ -19,7 +20,8 @@ class SeasonalARIMA():
                            "a seasonal ARIMA model on the input mosaic dataset, and predicts the change in the " \
                            "observed variable (pixel values). This currently only supports single band time-series " \
                            "rasters that generally contain scientific data."
-        self.times = []
+        self.times = None
+        self.train_indices = None
         self.data_start_year = None
         self.predict_month = None
         self.predict_year = None
@@ -141,7 +143,11 @@ class SeasonalARIMA():
         self.q = int(seasonal_order[2])
         self.s = int(seasonal_order[3])
 
-        self.times = kwargs['rasters_keyMetadata']
+        # chronological order of the collection is resolved once, not per pixel block
+        self.times = TimeIndex(kwargs['rasters_keyMetadata'], key='time')
+        train_data_start_index = (self.train_start_year - self.data_start_year) * 12
+        train_data_end_index = (self.train_end_year - self.data_start_year) * 12
+        self.train_indices = self.times.order[train_data_start_index:train_data_end_index]
 
         return kwargs
 
@@ -157,10 +163,9 @@ class SeasonalARIMA():
 
         pix_blocks = pixelBlocks['rasters_pixels']
         pix_array = np.asarray(pix_blocks)
-        pix_time = [j['time'] for j in self.times]
-
-        sorted_t = np.sort(pix_time)
-        sorted_t_idx = np.argsort(pix_time)
+        train_indices = self.train_indices
+        # training series of every pixel, contiguous along time
+        train_series = np.ascontiguousarray(np.moveaxis(pix_array[train_indices, 0], 0, -1))
 
         #pickle_filename = os.path.join(debug_logs_directory, fname)
         #pickle.dump(pix_blocks, open(pickle_filename[:-4]+'pix_blocks.p',"wb"))
@@ -185,18 +190,16 @@ class SeasonalARIMA():
         predict_month = self.predict_month
 
         train_data_end_index = (train_end_year - data_start_year) * 12
-        train_data_start_index = (train_start_year - data_start_year) * 12
         predict_data_end_index = (predict_year - train_end_year) * 12
         current_year_index = (current_year - train_end_year) * 12
 
         for num_x in range(0, int(num_squares_x)):
             for num_y in range(0, int(num_squares_y)):
 
-                data = pix_array[:, 0, num_x, num_y]
-                sorted_data = data[sorted_t_idx]
+                train_data = train_series[num_x, num_y]
                 try:
                     # define model
-                    model = sm.tsa.statespace.SARIMAX(sorted_data[train_data_start_index:train_data_end_index],
+                    model = sm.tsa.statespace.SARIMAX(train_data,
                                                       order=my_order,
                                                       seasonal_order=my_seasonal_order, trend='c',
                                                       enforce_invertibility=False, enforce_stationarity=False)
@@ -91,17 +91,9 @@ class StepwiseLocalRadiometricAdjustment:
         targ_img_arr = raster_clouds_pixels * (1 - clouds_img_arr[None, :, :])
         replace_img_arr = raster_noclouds_pixels * (clouds_img_arr[None, :, :])
 
-        image = 1 - clouds_img_arr
-        cnt_cycles = 0
-        while np.any((image == 0)) == True:
-            kernel = np.ones((5, 5), np.uint8)
-            expand = cv2.dilate(image, kernel, iterations=1)
-            cnt_cycles += 1
-            image = expand
-
         n_bands = targ_img_arr.shape[0]
         kernel_radius = win_size
-        num_cycles = cnt_cycles
+        rings = computeRings(clouds_img_arr, kernel_radius)
 
         filled_img_arr = np.zeros(
             (n_bands, targ_img_arr.shape[1], targ_img_arr.shape[2])
@@ -120,20 +112,11 @@ class StepwiseLocalRadiometricAdjustment:
                 "constant",
                 constant_values=(0,),
             )
-            test_clouds = clouds_img_arr[:, :]
-            test_clouds = np.pad(
-                1 - test_clouds,
-                ((kernel_radius, kernel_radius), (kernel_radius, kernel_radius)),
-                "constant",
-            )
             radio_norms = computeRadiometricAdjustment(
                 test_targ,
                 test_replace,
-                test_clouds,
+                rings,
                 kernel_radius,
-                num_cycles,
-                targ_img_arr.shape[2],
-                targ_img_arr.shape[1],
             )
             crop_test_targ = cropCenterNorm(
                 radio_norms, targ_img_arr.shape[2], targ_img_arr.shape[1]
@@ -202,33 +185,37 @@ def stepwiseAdjustment(cnts_list_, test_targ, test_replace, new_targ, ker_radius
     return new_targ
 
 
+def computeRings(clouds, kernel_radius):
+    # Cloud pixels are filled in rings growing from the clear pixels by a 5x5 dilation per cycle, so the
+    # ring of a pixel is its chessboard distance to the nearest clear pixel, divided by two and rounded up.
+    # Returns the (row, column) list of each ring in the image padded by kernel_radius, from one
+    # distance transform instead of one dilation of the whole image per cycle.
+    clouds = (clouds != 0).astype(np.uint8)
+    if clouds.all():
+        return []                   # no clear pixels to adjust from
+    distance = cv2.distanceTransform(clouds, cv2.DIST_C, 3)
+    cycle = np.ceil(distance / 2).astype(np.int64).ravel()
+
+    locs = np.flatnonzero(cycle)
+    locs = locs[np.argsort(cycle[locs], kind="stable")]
+    counts = np.bincount(cycle[locs])[1:]
+    cnts_list_ = np.transpose(np.array(np.unravel_index(locs, clouds.shape)), (1, 0)) + kernel_radius
+    return np.split(cnts_list_, np.cumsum(counts)[:-1])
+
+
 def computeRadiometricAdjustment(
     test_targ,
     test_replace,
-    test_clouds,
+    rings,
     kernel_radius,
-    num_cycles,
-    org_shp_1,
-    org_shp_2,
 ):
-    for i in range(num_cycles):
-        kernel = np.ones((5, 5), np.uint8)
-        dilation_test_clouds = cv2.dilate(test_clouds, kernel, iterations=1)
-        boundry_no_pad = dilation_test_clouds - test_clouds
-        boundry_croped = cropCenterNorm(boundry_no_pad, org_shp_1, org_shp_2)
-        boundry = np.pad(
-            boundry_croped,
-            ((kernel_radius, kernel_radius), (kernel_radius, kernel_radius)),
-            "constant",
-            constant_values=(0,),
-        )
-        locs = np.where(boundry == 1)
-        cnts_list_ = np.transpose(np.array((locs[0], locs[1])), (1, 0))
-        new_targ = np.zeros((test_targ.shape[0], test_targ.shape[1]))
+    test_targ = test_targ.astype(np.float64)
+    new_targ = np.zeros((test_targ.shape[0], test_targ.shape[1]))
+    for cnts_list_ in rings:
         ker_radius = kernel_radius
         new_targ = stepwiseAdjustment(
             cnts_list_, test_targ, test_replace, new_targ, ker_radius
         )
-        test_clouds = dilation_test_clouds
-        test_targ = test_targ + new_targ
+        x, y = cnts_list_[:, 0], cnts_list_[:, 1]
+        test_targ[x, y] += new_targ[x, y]       # only the ring changes in a cycle
     return test_targ
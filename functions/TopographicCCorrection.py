@@ -1,7 +1,7 @@
 import numpy as np
 from numpy import pi
+from utils import LRUCache
 #import datetime
-import scipy.stats as stats
 #from datetime import timedelta
 #import sys
 
@@ -24,6 +24,9 @@ LANDSAT_CLEAR_PIX_VALS = LANDSAT_4_7_CLEAR_PIX_VALS + LANDSAT_8_CLEAR_PIX_VALS
 # 3. Holben et al (1980) https://www.asprs.org/wp-content/uploads/pers/1980journal/sep/1980_sep_1191-1200.pdf
 # 4. Dr. Mort Canty - https://github.com/mortcanty/CRCPython
 
+# C of every band of the scenes estimated so far, by scene and terrain datasets
+coefficientCache = LRUCache(256)
+
 class TopographicCCorrection():
 
     def __init__(self):
@@ -57,6 +60,41 @@ class TopographicCCorrection():
                 'required': True,
                 'displayName': "Aspect",
                 'description': "Aspect Derived from Digital Elevation Model."
+            },
+            {
+                'name': 'c_mode',
+                'dataType': 'string',
+                'value': 'Tile',
+                'required': False,
+                'displayName': "C Estimation",
+                'domain': ('Tile', 'Scene'),
+                'description': ("Fit the C parameter to the pixels of each tile, or once per scene and band from "
+                                "a stratified sample of the whole raster, which avoids seams between tiles.")
+            },
+            {
+                'name': 'scene_paths',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "Scene Datasets",
+                'description': ("Paths of the scene datasets in the order of the collection, separated by "
+                                "semicolons. Sampled with arcpy by the Scene C estimation.")
+            },
+            {
+                'name': 'slope_path',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "Slope Dataset",
+                'description': "Path of the slope dataset, sampled with arcpy by the Scene C estimation."
+            },
+            {
+                'name': 'aspect_path',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "Aspect Dataset",
+                'description': "Path of the aspect dataset, sampled with arcpy by the Scene C estimation."
             }
         ]
 
@@ -66,7 +104,7 @@ class TopographicCCorrection():
             'invalidateProperties': 2 | 4,      # invalidate histogram and statistics because we are modifying pixel values
             'inputMask': True,                  # need raster mask of all input rasters in .updatePixels().
             'resampling': False,                # process at native resolution
-            'keyMetadata': ['SunAzimuth','SunElevation','AcquisitionDate']
+            'keyMetadata': ['SunAzimuth','SunElevation','AcquisitionDate','SceneID']
         }
 
     def updateRasterInfo(self, **kwargs):
@@ -78,6 +116,16 @@ class TopographicCCorrection():
         kwargs['output_info']['statistics'] = ()            # outStatsTuple
 
         self.metadata = kwargs['rasters_keyMetadata']
+        if len(self.metadata) > 1 and 'rasters_info' in kwargs:      # the bands of all scenes, scene by scene
+            kwargs['output_info']['bandCount'] = sum(r['bandCount'] for r in kwargs['rasters_info'])
+
+        self.sceneC = str(kwargs.get('c_mode', 'Tile')).lower() == 'scene'
+        self.scenePaths = [x.strip() for x in str(kwargs.get('scene_paths', '') or '').split(';') if x.strip()]
+        self.terrainPaths = (str(kwargs.get('slope_path', '')), str(kwargs.get('aspect_path', '')))
+        if self.sceneC and len(self.scenePaths) < len(self.metadata):
+            raise Exception("Scene C estimation needs the path of every scene dataset")
+        self.extent = kwargs['output_info'].get('extent')
+        self.cellSize = kwargs['output_info'].get('cellSize')
 
         return kwargs
 
@@ -108,7 +156,6 @@ class TopographicCCorrection():
         ##pickle.dump(aspect_rads, open(pickle_filename[:-4]+'aspect.p',"wb"))
 
 
-        t_vals = [j['acquisitiondate'] for j in self.metadata]
         sun_az = [j['sunazimuth'] for j in self.metadata]
         sun_el = [j['sunelevation'] for j in self.metadata]
 
@@ -119,36 +166,103 @@ class TopographicCCorrection():
         #Equation
         #Corrected Image = Image * (cos(solar zenith angle) + C)/(cos(solar incidence angle) + C)
         #Where C is an empiraicle parameter
-        #cos(solar incidence angle) =
+        #cos(solar incidence angle) = cos(slope)cos(zenith) + sin(slope)sin(zenith)cos(azimuth - aspect)
         pix_array_dim = image_pix_array.shape
+        num_scenes = pix_array_dim[0]
         num_bands = pix_array_dim[1]
         num_squares_x = pix_array_dim[2]
         num_squares_y = pix_array_dim[3]
-        result = np.zeros((num_bands, num_squares_x, num_squares_y))
-
-        if len(sun_az) == 1:
-            sun_az_rad = sun_az[0] * pi / 180
-            sun_ze_rad = sun_ze[0] * pi / 180
-
-            # Topographic Effect on Spectral Response from Nadir-Pointing Sensors
-            # https://www.asprs.org/wp-content/uploads/pers/1980journal/sep/1980_sep_1191-1200.pdf
-            cos_i = (np.cos(slope_rads[0, :, :]) * np.cos(sun_ze_rad)) + \
-                    (np.sin(slope_rads[0, :, :] * np.sin(sun_ze_rad)) * (np.cos(sun_az_rad - aspect_rads[0, :, :])))
+        result = np.zeros((num_scenes, num_bands, num_squares_x, num_squares_y), dtype='f4')
 
-            for k in range(num_bands):
-                image_flattened = image_pix_array[0, k, :, :].ravel()
-                cos_gamma = cos_i.ravel()
+        # terms of the incidence angle that depend on the terrain only, shared by all scenes
+        terrain = self.computeTerrainTerms(slope_rads[0], aspect_rads[0])
 
-                # Adding linear regression from Dr. Mort Canty - https://github.com/mortcanty/CRCPython
-                m, b, r, _, _ = stats.linregress(cos_gamma, image_flattened)
+        for t in range(min(num_scenes, len(sun_az))):
+            sun_az_rad = sun_az[t] * pi / 180
+            sun_ze_rad = sun_ze[t] * pi / 180
+            cos_i = self.computeCosI(terrain, sun_az_rad, sun_ze_rad)
 
-                C = b / m
+            image = np.asarray(image_pix_array[t], dtype='f4')
+            if self.sceneC:
+                C = self.estimateSceneC(t, sun_az_rad, sun_ze_rad)[:, None, None]
+            else:
+                C = self.computeC(cos_i, image)[:, None, None]
+            np.multiply(image, (np.float32(np.cos(sun_ze_rad)) + C) / (cos_i + C), out=result[t])
 
-                result[k, :, :] = image_pix_array[0, k, :, :] * (np.cos(sun_ze_rad) + C) / (cos_i + C)
-
-
-        mask = np.ones((pix_array_dim[1], num_squares_x, num_squares_y))
+        result = result.reshape((num_scenes * num_bands, num_squares_x, num_squares_y))
+        mask = np.ones(result.shape)
         pixelBlocks['output_mask'] = mask.astype('u1', copy = False)
         pixelBlocks['output_pixels'] = result.astype(props['pixelType'], copy=False)
 
         return pixelBlocks
+
+    def computeTerrainTerms(self, slope_rads, aspect_rads):
+        return (np.cos(slope_rads).astype('f4'), np.sin(slope_rads).astype('f4'),
+                np.cos(aspect_rads).astype('f4'), np.sin(aspect_rads).astype('f4'))
+
+    def computeCosI(self, terrain, sun_az_rad, sun_ze_rad):
+        # Topographic Effect on Spectral Response from Nadir-Pointing Sensors
+        # https://www.asprs.org/wp-content/uploads/pers/1980journal/sep/1980_sep_1191-1200.pdf
+        # cos(azimuth - aspect) = cos(azimuth)cos(aspect) + sin(azimuth)sin(aspect)
+        cos_slope, sin_slope, cos_aspect, sin_aspect = terrain
+        return cos_slope * np.float32(np.cos(sun_ze_rad)) + sin_slope * \
+               (cos_aspect * np.float32(np.sin(sun_ze_rad) * np.cos(sun_az_rad)) +
+                sin_aspect * np.float32(np.sin(sun_ze_rad) * np.sin(sun_az_rad)))
+
+    def estimateSceneC(self, t, sun_az_rad, sun_ze_rad, strata=8, size=64):
+        # C of every band of scene t, fitted once to a stratified sample of the whole raster: a window of
+        # size x size cells at a random position within each cell of a strata x strata grid over the raster.
+        # Scene and terrain datasets are read with arcpy at their own cell size, which must be that of the
+        # output raster for the windows of all three to line up.
+        m = self.metadata[t]
+        scene = m.get('sceneid') or (m.get('acquisitiondate'), m['sunazimuth'], m['sunelevation'])
+        key = (str(scene), self.scenePaths[t]) + self.terrainPaths
+
+        def estimate():
+            arcpy = __import__('arcpy')
+            e, (cx, cy) = self.extent, self.cellSize
+            for path in (self.scenePaths[t],) + self.terrainPaths:
+                d = arcpy.Describe(path)
+                if not np.allclose((d.meanCellWidth, d.meanCellHeight), (cx, cy), rtol=1e-6):
+                    raise Exception("Cell size of {0} ({1}, {2}) differs from the output cell size ({3}, {4}), "
+                                    "resample it to estimate C per scene".format(path, d.meanCellWidth, d.meanCellHeight, cx, cy))
+            nRows, nCols = int(round((e[3] - e[1]) / cy)), int(round((e[2] - e[0]) / cx))
+            rng = np.random.RandomState(0)
+            x, y = [], []
+            for i in range(strata):
+                for j in range(strata):
+                    r0, r1 = i * nRows // strata, (i + 1) * nRows // strata
+                    c0, c1 = j * nCols // strata, (j + 1) * nCols // strata
+                    rows, cols = min(size, r1 - r0), min(size, c1 - c0)
+                    if rows <= 0 or cols <= 0:
+                        continue
+                    row, col = rng.randint(r0, r1 - rows + 1), rng.randint(c0, c1 - cols + 1)
+                    corner = arcpy.Point(e[0] + col * cx, e[3] - (row + rows) * cy)
+                    read = lambda path: np.asarray(arcpy.RasterToNumPyArray(path, corner, cols, rows, 0), dtype='f4')
+
+                    image = read(self.scenePaths[t]).reshape(-1, rows, cols)
+                    slope, aspect = read(self.terrainPaths[0]), read(self.terrainPaths[1])
+                    cos_i = self.computeCosI(self.computeTerrainTerms(slope * pi/180, aspect * pi/180), sun_az_rad, sun_ze_rad)
+                    valid = (image != 0).all(axis=0)        # NoData is read as 0, like Landsat fill
+                    x.append(cos_i[valid])
+                    y.append(image[:, valid])
+
+            x, y = np.concatenate(x), np.concatenate(y, axis=1)
+            if len(x) < 2:
+                raise Exception("No valid pixels to estimate C of scene {0}".format(scene))
+            return self.computeC(x, y)
+
+        return coefficientCache.lookup(key, estimate)
+
+    def computeC(self, cos_i, image):
+        # C = intercept/slope of the least-squares line image = slope*cos_i + intercept, for all bands of a
+        # scene at once from the centered sums. Adapted from the linear regression by Dr. Mort Canty
+        # - https://github.com/mortcanty/CRCPython
+        # The sums are taken in float64, float32 loses precision over a whole tile or scene sample.
+        x = cos_i.ravel().astype('f8')
+        y = image.reshape(len(image), -1).astype('f8')
+        x_mean = x.mean()
+        x_centered = x - x_mean
+        m = np.dot(y, x_centered) / np.dot(x_centered, x_centered)
+        b = y.mean(axis=1) - m * x_mean
+        return (b / m).astype('f4')
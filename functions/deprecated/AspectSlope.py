@@ -15,10 +15,10 @@
 # Copyright	    	: (c) ESRI 2016
 # License	    	: ESRI Internal.
 #---------------------------------------------------------------------------------------------
-from scipy import ndimage
 import math
 from decimal import *
 import numpy as np
+from utils import terrainDerivatives
 
 
 class AspectSlope():
@@ -77,42 +77,14 @@ class AspectSlope():
         dem = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)[0]                     # Input pixel array.
         m = np.array(pixelBlocks['raster_mask'], dtype='u1', copy=False)[0]                         # Input raster mask.
         self.noData = self.assignNoData(props['pixelType']) if not(props['noData']) else props['noData']
-        xKernel = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])                                    # Weights for calculation of dz/dx value array.
-        yKernel = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])                                    # Weights for calculation of dz/dy value array.
-        temp = np.where(np.not_equal(dem, self.noData), dem, dem)
         p = props['cellSize']
-        deltaX = (ndimage.convolve(temp, xKernel)) / 8                                              # dz/dx values.
-        deltaY = (ndimage.convolve(temp, yKernel)) / 8                                              # dz/dy values.
         if (p[0] <= 0) | (p[1] <= 0):
             raise Exception("Input raster cell size is invalid.")
-        dx = deltaX / p[0]                                                                          # Divide by cell size.
-        dy = deltaY / p[1]
-        dx = dx * self.zf                                                                           # Multiply by z-factor.
-        dy = dy * self.zf
-        slopeTangent = (np.sqrt((dx * dx) + (dy * dy))) * 100                                       # Slope Calculation.
-        aspect = 57.29578 * np.arctan2(deltaX, (-1) * deltaY)                                       # Aspect Calculation.
-        aspect[(aspect < 0.00)] = (360.00 - (90.00 - aspect[(aspect < 0.00)])) + 90
-        aspect[slopeTangent == 0] = -1                                                              # Aspect assigned -1 for slope values 0.
-        slopeTangent[(slopeTangent >= 0) & (slopeTangent < 5)] = -10
-        slopeTangent[(slopeTangent >= 5) & (slopeTangent < 20)] = -20
-        slopeTangent[(slopeTangent >= 20) & (slopeTangent < 40)] = -30
-        slopeTangent[(slopeTangent >= 40)] = -40
-        slopeTangent[(slopeTangent == -10)] = 10
-        slopeTangent[(slopeTangent == -20)] = 20
-        slopeTangent[(slopeTangent == -30)] = 30
-        slopeTangent[(slopeTangent == -40)] = 40
-        aspect[(aspect >= -1) & (aspect <= 22.5)] = 1
-        aspect[(aspect > 22.5) & (aspect <= 67.5)] = 2
-        aspect[(aspect > 67.5) & (aspect <= 112.5)] = 3
-        aspect[(aspect > 112.5) & (aspect <= 157.5)] = 4
-        aspect[(aspect > 157.5) & (aspect <= 202.5)] = 5
-        aspect[(aspect > 202.5) & (aspect <= 247.5)] = 6
-        aspect[(aspect > 247.5) & (aspect <= 292.5)] = 7
-        aspect[(aspect > 292.5) & (aspect <= 337.5)] = 8
-        aspect[(aspect > 337.5) & (aspect <= 360)] = 1
-        finalArray = np.add(slopeTangent, aspect)                                                   # Add the slope and aspect arrays.
-        finalArray[(finalArray >= 11) & (finalArray <= 18)] = 19
-        pixelBlocks['output_pixels'] = finalArray[1:-1, 1:-1].astype(props['pixelType'])
+        slopeTangent, aspect = terrainDerivatives(dem, p, self.zf, ('percentSlope', 'aspect'))  # Slope in percent, aspect -1 where flat.
+        slopeClass = np.digitize(slopeTangent, self.slopeBreaks)                                    # 0-3: <5, <20, <40, >=40 percent.
+        aspectClass = np.digitize(aspect, self.aspectBreaks, right=True)                            # 0-8: octants up to 22.5, 67.5, ... and above 337.5 degrees.
+        finalArray = self.classes[slopeClass * 9 + aspectClass]                                     # Combined slope-aspect class codes.
+        pixelBlocks['output_pixels'] = finalArray.astype(props['pixelType'])
         pixelBlocks['output_mask'] = \
             m[:-2, :-2]  & m[1:-1, :-2]  & m[2:, :-2]  \
             & m[:-2, 1:-1] & m[1:-1, 1:-1] & m[2:, 1:-1] \
@@ -139,3 +111,9 @@ class AspectSlope():
 
     def prepare(self, zFactor=1):
         self.zf = zFactor
+        self.slopeBreaks = np.array([5., 20., 40.], dtype='f4')
+        self.aspectBreaks = np.array([22.5, 67.5, 112.5, 157.5, 202.5, 247.5, 292.5, 337.5], dtype='f4')
+        slopes = np.array([10, 20, 30, 40], dtype='u1')                                              # Slope class codes.
+        aspects = np.array([1, 2, 3, 4, 5, 6, 7, 8, 1], dtype='u1')                                  # Aspect class codes, north wraps around.
+        self.classes = (slopes[:, None] + aspects[None, :]).ravel()                                  # Lookup table of combined codes.
+        self.classes[self.classes <= 18] = 19                                                        # Gentle slopes (11-18) are one class regardless of aspect.
@@ -1,7 +1,5 @@
-﻿from scipy import ndimage
-import numpy as np
-import math
-from utils import computeCellSize, Projection, isGeographic, projectCellSize
+﻿import numpy as np
+from utils import computeCellSize, Projection, isGeographic, projectCellSize, terrainDerivatives
 
 
 class Hillshade():
@@ -50,6 +48,43 @@ class Hillshade():
                                 "Specify zero to disable dynamic scaling. "
                                 "zf <- zf + cf*[p^ce]/8p."),
             },
+            {
+                'name': 'azimuth',
+                'dataType': 'string',
+                'value': '315',
+                'required': False,
+                'displayName': "Azimuth",
+                'description': ("The direction of the light source in degrees clockwise from north. "
+                                "Separate several directions with commas, e.g. 225, 270, 315, 360."),
+            },
+            {
+                'name': 'elevation',
+                'dataType': 'string',
+                'value': '45',
+                'required': False,
+                'displayName': "Elevation",
+                'description': ("The angle of the light source above the horizon in degrees. "
+                                "A single value applies to all azimuths, otherwise give one per azimuth."),
+            },
+            {
+                'name': 'weights',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "Weights",
+                'description': ("The weight of each light source in the blend, one per azimuth. "
+                                "Leave empty to weight all light sources equally."),
+            },
+            {
+                'name': 'combine',
+                'dataType': 'string',
+                'value': 'Blend',
+                'required': False,
+                'displayName': "Multiple Light Sources",
+                'domain': ('Blend', 'Bands'),
+                'description': ("Blend the hillshades of several light sources into one weighted multidirectional "
+                                "hillshade, or output the hillshade of each light source as a separate band."),
+            },
         ]
 
     def getConfiguration(self, **scalars):
@@ -63,74 +98,93 @@ class Hillshade():
         }
 
     def updateRasterInfo(self, **kwargs):
-        kwargs['output_info']['bandCount'] = 1
-        kwargs['output_info']['pixelType'] = 'u1'
-        kwargs['output_info']['statistics'] = ({'minimum': 0., 'maximum': 255.}, )
-        kwargs['output_info']['histogram'] = ()
-        kwargs['output_info']['colormap'] = ()
-
         r = kwargs['raster_info']
         if r['bandCount'] > 1:
             raise Exception("Input raster has more than one band. Only single-band raster datasets are supported")
 
-        self.prepare(zFactor=kwargs.get('zf', 1.),
+        self.prepare(azimuth=parseNumbers(kwargs.get('azimuth', '315'), 315.),
+                     elevation=parseNumbers(kwargs.get('elevation', '45'), 45.),
+                     zFactor=kwargs.get('zf', 1.),
                      cellSizeExponent=kwargs.get('ce', 0.664),
                      cellSizeFactor=kwargs.get('cf', 0.024),
-                     sr=r['spatialReference'])
+                     sr=r['spatialReference'],
+                     weights=parseNumbers(kwargs.get('weights', ''), None),
+                     bands=str(kwargs.get('combine', 'Blend')).lower() == 'bands')
+
+        n = len(self.azimuth) if self.bands else 1
+        kwargs['output_info']['bandCount'] = n
+        kwargs['output_info']['pixelType'] = 'u1'
+        kwargs['output_info']['statistics'] = n * ({'minimum': 0., 'maximum': 255.}, )
+        kwargs['output_info']['histogram'] = ()
+        kwargs['output_info']['colormap'] = ()
         return kwargs
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
         v = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)[0]
         m = np.array(pixelBlocks['raster_mask'], dtype='u1', copy=False)[0]
 
-        dx, dy = self.computeGradients(v, props)
-        outBlock = self.computeHillshade(dx, dy)
+        outBlock, = self.computeHillshade(v, props)          # one band per light source
+        if not self.bands:
+            outBlock = np.tensordot(self.weights, outBlock, axes=1) if len(outBlock) > 1 else outBlock[0]
 
-        pixelBlocks['output_pixels'] = outBlock[1:-1, 1:-1].astype(props['pixelType'], copy=False)
-        pixelBlocks['output_mask'] = \
+        mask = \
             m[:-2, :-2]  & m[1:-1, :-2]  & m[2:, :-2]  \
           & m[:-2, 1:-1] & m[1:-1, 1:-1] & m[2:, 1:-1] \
           & m[:-2, 2:]   & m[1:-1, 2:]   & m[2:, 2:]
+        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+        pixelBlocks['output_mask'] = np.broadcast_to(mask, outBlock.shape) if outBlock.ndim == 3 else mask
         return pixelBlocks
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
             keyMetadata['datatype'] = 'Processed'       # outgoing dataset is now 'Processed'
-        elif bandIndex == 0:                            # properties for the first band
+        elif bandIndex == 0 or (self.bands and bandIndex < len(self.azimuth)):
             keyMetadata['wavelengthmin'] = None         # reset inapplicable band-specific key metadata
             keyMetadata['wavelengthmax'] = None
             keyMetadata['bandname'] = 'Hillshade'
+            if self.bands and len(self.azimuth) > 1:    # name each band by its light source
+                keyMetadata['bandname'] = 'Hillshade_{0:g}_{1:g}'.format(self.azimuth[bandIndex], self.elevation[bandIndex])
         return keyMetadata
 
     # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
     # other public methods...
 
-    def prepare(self, azimuth=315., elevation=45., zFactor=1., cellSizeExponent=0.664, cellSizeFactor=0.024, sr=None):
-        Z = (90. - elevation) * math.pi / 180.   # solar _zenith_ angle in radians
-        A = (90. - azimuth) * math.pi / 180.     # solar azimuth _arithmetic_ angle in radians
-        sinZ = math.sin(Z)
-        self.cosZ = math.cos(Z)
-        self.sinZsinA = sinZ * math.sin(A)
-        self.sinZcosA = sinZ * math.cos(A)
-        self.xKernel = np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]])
-        self.yKernel = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    def prepare(self, azimuth=315., elevation=45., zFactor=1., cellSizeExponent=0.664, cellSizeFactor=0.024, sr=None,
+                weights=None, bands=False):
+        # azimuth and elevation may be sequences of light sources, a single elevation applies to all azimuths
+        azimuth, elevation = np.atleast_1d(azimuth).astype('f8'), np.atleast_1d(elevation).astype('f8')
+        if len(elevation) not in (1, len(azimuth)):
+            raise Exception("Specify a single elevation or one elevation per azimuth")
+        self.azimuth, self.elevation = np.broadcast_arrays(azimuth, elevation)
+
+        weights = np.ones(len(self.azimuth)) if weights is None else np.atleast_1d(weights).astype('f8')
+        if len(weights) != len(self.azimuth) or (weights < 0).any() or weights.sum() <= 0:
+            raise Exception("Specify one non-negative weight per azimuth, with a positive sum")
+        self.weights = (weights / weights.sum()).astype('f4')
+        self.bands = bands
         self.zf = zFactor
         self.ce = cellSizeExponent
         self.cf = cellSizeFactor
         self.sr = sr
 
-    def computeGradients(self, pixelBlock, props):
+    def computeScale(self, props):
         # pixel size in input raster SR...
         p = props['cellSize'] if self.sr is None else projectCellSize(props['cellSize'], props['spatialReference'], self.sr, self.proj)
         if p is not None and len(p) == 2:
             p = np.multiply(p, 1.11e5 if isGeographic(self.sr) else 1.)   # conditional degrees to meters conversion
-            xs, ys = (self.zf + (np.power(p, self.ce) * self.cf)) / (8*p)
-        else:
-            xs, ys = 1., 1.         # degenerate case. shouldn't happen.
-        return (ndimage.convolve(pixelBlock, self.xKernel)*xs, ndimage.convolve(pixelBlock, self.yKernel)*ys)
+            return p, self.zf + (np.power(p, self.ce) * self.cf)
+        return (0.125, 0.125), 1.   # degenerate case. shouldn't happen.
+
+    def computeHillshade(self, pixelBlock, props, products=('hillshade',)):
+        # the hillshade of every light source is computed from the same gradients
+        p, zf = self.computeScale(props)
+        return terrainDerivatives(pixelBlock, p, zf, products, self.azimuth, self.elevation)
+
 
-    def computeHillshade(self, dx, dy):
-        return np.clip(255 * (self.cosZ + dy*self.sinZsinA - dx*self.sinZcosA) / np.sqrt(1. + (dx*dx + dy*dy)), 0., 255.)
+def parseNumbers(s, default):
+    # parses a comma-separated list of numbers, returning default for an empty string
+    values = [float(x) for x in str(s if s is not None else '').split(',') if x.strip()]
+    return values if values else default
 
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
 
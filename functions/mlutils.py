@@ -0,0 +1,680 @@
+#------------------------------------------------------------------------------
+# Copyright 2016 Esri
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#------------------------------------------------------------------------------
+
+# Support for the scikit-learn classifier raster functions.
+
+__all__ = ['loadTrainingData',
+           'convertTrainingData',
+           'trainModel',
+           'validPixels',
+           'predictPixels',
+           'classifyPixels',
+           'neighborIndex',
+           'voteNeighbors',
+           'ModelServer',
+           'RemoteModel',
+           'serverAddress',]
+
+import os
+import pickle
+import struct
+import json
+import hashlib
+import tempfile
+from stat import S_ISDIR, S_ISREG
+from time import sleep, time
+from utils import LRUCache
+
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- #
+
+labelField = 'VarToPredict'                                     # the value that you probably want to predict
+dropFields = ('OBJECTID', 'LOCATION_X', 'LOCATION_Y')           # fields that aren't used in the analysis
+
+# fitted models are held in process memory and persisted here, so that each worker trains at most once.
+# The folder is private to the user, see _privateFolder.
+cacheFolder = os.environ.get('RASTER_FUNCTIONS_CACHE') or os.path.join(
+    tempfile.gettempdir(), 'raster-functions-{0}'.format(os.getuid() if hasattr(os, 'getuid') else os.environ.get('USERNAME', '')))
+models = LRUCache(4)
+
+# predictions of recently seen pixel vectors (spectra), one cache per model and input type
+spectra = LRUCache(8)
+spectraPerModel = 1 << 16
+
+
+def loadTrainingData(datafile, label=labelField, drop=dropFields):
+    # Reads training samples from a CSV file into a float feature matrix and a label vector.
+    # Missing or null values are filled with 0, the models won't work otherwise.
+    # A .npz file written by convertTrainingData is memory-mapped instead of parsed: its fields were
+    # dropped and its nulls filled at conversion, and it holds float32 features.
+    if os.path.splitext(datafile)[1].lower() == '.npz':
+        arrays = _mapArchive(datafile)
+        return arrays['x'], arrays['y']
+
+    pd = __import__('pandas')
+    df = pd.read_csv(datafile)
+    df.drop(list(drop), axis=1, inplace=True, errors='ignore')
+    df.fillna(0, inplace=True)
+    x = df.loc[:, df.columns != label].values.astype('f8')
+    y = df[label].values
+    return x, y
+
+
+def convertTrainingData(datafile, outfile=None, label=labelField, drop=dropFields):
+    # Converts a training CSV file to the binary form that loadTrainingData maps without parsing:
+    # an uncompressed .npz with the float32 feature columns (x, column-major), the labels (y, as
+    # integers when they are whole numbers), and the names of the features and the label.
+    # Returns the path of the new file, which defaults to the CSV file with an .npz extension.
+    np = __import__('numpy')
+    pd = __import__('pandas')
+    df = pd.read_csv(datafile)
+    df.drop(list(drop), axis=1, inplace=True, errors='ignore')
+    df.fillna(0, inplace=True)
+    features = [c for c in df.columns if c != label]
+
+    y = df[label].values
+    if y.dtype.kind == 'f' and np.array_equal(y, np.round(y)):
+        y = y.astype('i8')
+    elif y.dtype.kind == 'O':
+        y = y.astype('U')
+
+    outfile = outfile or os.path.splitext(datafile)[0] + '.npz'
+    with open(outfile, 'wb') as f:
+        np.savez(f, x=np.asfortranarray(df[features].values, dtype='f4'), y=y,
+                 features=np.array(features, dtype='U'), label=np.array(label, dtype='U'))
+    return outfile
+
+
+def trainModel(datafile, estimator, **params):
+    # Returns (model, labels) where model is estimator(**params) fitted on the training data in datafile.
+    # Fits are keyed by file path, modification time, estimator, and hyperparameters. A fit is
+    # looked up in process memory first, then on disk, and only computed if neither has it.
+    path = os.path.abspath(datafile)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size,
+           estimator.__module__ + '.' + estimator.__name__,
+           tuple(sorted(params.items())))
+
+    def fit():
+        x, y = loadTrainingData(path)
+        return estimator(**params).fit(x, y), y
+
+    return models.lookup(key, lambda: _persisted(key, fit))
+
+
+def validPixels(masks):
+    # Combines the masks of all input rasters into a (rows, cols) boolean array of pixels
+    # that are valid in every raster. Returns None if no masks were supplied.
+    if masks is None:
+        return None
+    np = __import__('numpy')
+    m = np.asarray(masks)
+    return np.all(m.reshape((-1,) + m.shape[-2:]), axis=0)
+
+
+def predictPixels(predict, pixels, mask=None, bands=1, chunkSize=65536, threads=1, unique=False, cacheKey=None):
+    # Evaluates predict over the valid pixels of a (features, rows, cols) pixel block and returns a
+    # float32 (bands, rows, cols) block. predict maps an (n, features) array to (n, bands) or (n,) values.
+    # Pixels are fed in chunks of at most chunkSize, which bounds the temporary memory of the model,
+    # optionally on several threads. Masked pixels are never computed and are left as 0.
+    # With unique, identical pixel vectors of the block are predicted once. A cacheKey that identifies the
+    # model and predict additionally keeps the predictions of recent vectors for the next pixel blocks,
+    # which only pays off when most vectors repeat across blocks.
+    np = __import__('numpy')
+    nRows, nCols = pixels.shape[-2:]
+    x = pixels.reshape(-1, nRows * nCols)
+    chunkSize = max(1, int(chunkSize))
+    out = np.zeros((bands, nRows * nCols), dtype='f4')
+    I = np.flatnonzero(mask) if mask is not None else None
+    n = len(I) if I is not None else nRows * nCols
+
+    if unique or cacheKey is not None:
+        if n:
+            y = _predictUnique(predict, x[:, I] if I is not None else x, bands, chunkSize, threads, cacheKey)
+            out[:, I if I is not None else slice(None)] = y
+        return out.reshape(bands, nRows, nCols)
+
+    def run(k):
+        j = I[k:k+chunkSize] if I is not None else slice(k, min(k+chunkSize, n))
+        y = np.asarray(predict(np.ascontiguousarray(x[:, j].T)))
+        out[:, j] = y.reshape(y.shape[0], -1).T
+
+    starts = range(0, n, chunkSize)
+    if threads > 1 and len(starts) > 1:
+        futures = __import__('concurrent.futures', fromlist=['ThreadPoolExecutor'])
+        with futures.ThreadPoolExecutor(int(threads)) as executor:
+            list(executor.map(run, starts))
+    else:
+        for k in starts:
+            run(k)
+    return out.reshape(bands, nRows, nCols)
+
+
+def classifyPixels(model, pixels, mask=None, chunkSize=65536, threads=1, unique=False, remember=False):
+    # Classifies a (features, rows, cols) pixel block by running model.predict_proba exactly once per pixel.
+    # Returns a float32 (1 + classes, rows, cols) block: the predicted class (the label of the most
+    # probable class, as model.predict would give) followed by the probability of each class.
+    # With unique, each distinct pixel vector of the block is classified once, with remember the results
+    # are also kept for the next blocks.
+    np = __import__('numpy')
+    classes = model.classes_
+
+    def predict(x):
+        p = model.predict_proba(x)
+        y = np.empty((len(x), 1 + len(classes)), dtype='f4')
+        y[:, 1:] = p
+        y[:, 0] = classes[p.argmax(axis=1)]
+        return y
+
+    return predictPixels(predict, pixels, mask, 1 + len(classes), chunkSize, threads,
+                         unique, ('classify', model) if unique and remember else None)
+
+
+def _predictUnique(predict, x, bands, chunkSize, threads, cacheKey):
+    # Predicts the distinct columns of the (features, n) pixels x and scatters them back to (bands, n).
+    # Columns are compared as raw bytes, so -0. and 0. or NaN payloads count as different vectors.
+    np = __import__('numpy')
+    v = np.ascontiguousarray(x.T)
+    width = v.dtype.itemsize * v.shape[1]
+    if width in (1, 2, 4, 8):
+        keys = v.view('u%d' % width).ravel()                     # sorts much faster than raw bytes
+    else:
+        keys = v.view(np.dtype((np.void, width))).ravel()
+    u, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    y = np.empty((len(u), bands), dtype='f4')
+    todo = np.ones(len(u), dtype=bool)
+    cache = None
+    if cacheKey is not None:
+        cacheKey = tuple(cacheKey) + (bands, v.dtype.str, v.shape[1])
+        cache = spectra.lookup(cacheKey, lambda: LRUCache(spectraPerModel))
+        u = u.tolist()
+        with cache.lock:
+            for i, key in enumerate(u):
+                hit = cache.get(key)
+                if hit is not None:
+                    y[i] = hit
+                    todo[i] = False
+
+    J = np.flatnonzero(todo)
+    if len(J):
+        z = v[first[J]].T.reshape(v.shape[1], 1, len(J))
+        y[J] = predictPixels(predict, z, None, bands, chunkSize, threads).reshape(bands, -1).T
+        if cache is not None:
+            with cache.lock:
+                for i in J.tolist():
+                    cache.put(u[i], y[i].copy())
+    return y[inverse.ravel()].T
+
+
+def neighborIndex(datafile, leafSize=30):
+    # Returns (tree, labels): a KD-tree over the training features in datafile, and the training labels.
+    # The tree is built once per training set and saved as a flat array file in the cache folder.
+    # Every worker process memory-maps that file read-only, so the index is shared, not copied.
+    # The leaf size defaults to that of KNeighborsClassifier and NearestNeighbors: the tree decides which
+    # of several equidistant samples are returned, so the same tree gives the same neighbors and votes.
+    sklearn = __import__('sklearn')
+    KDTree = __import__('sklearn.neighbors', fromlist=['KDTree']).KDTree
+    path = os.path.abspath(datafile)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size, 'KDTree', leafSize, sklearn.__version__)
+
+    def build():
+        x, y = loadTrainingData(path)
+        return KDTree(x, leaf_size=leafSize).__getstate__(), y
+
+    def load():
+        state, y = _persisted(key, build, '.kdt', _dumpArrays, _loadArrays)
+        tree = KDTree.__new__(KDTree)
+        tree.__setstate__(state)
+        return tree, y
+
+    return models.lookup(key, load)
+
+
+def voteNeighbors(ind, codes, nClasses):
+    # Majority vote over the neighbors of each query, as KNeighborsClassifier with uniform weights.
+    # ind: (n, k) indices of training samples; codes: class index of each training sample.
+    # Returns the winning class index of each query, ties go to the smallest class.
+    np = __import__('numpy')
+    n = ind.shape[0]
+    votes = codes[ind] + nClasses * np.arange(n)[:, None]
+    return np.bincount(votes.ravel(), minlength=n * nClasses).reshape(n, nClasses).argmax(axis=1)
+
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- #
+
+def serverAddress():
+    # The address of the model server on this machine, from RASTER_FUNCTIONS_SERVER if it is set.
+    # Defaults to a named pipe on Windows, and to a Unix domain socket in the private cache folder otherwise.
+    if os.environ.get('RASTER_FUNCTIONS_SERVER'):
+        return os.environ['RASTER_FUNCTIONS_SERVER']
+    if os.name == 'nt':
+        return r'\\.\pipe\raster-functions-models'
+    return os.path.join(_privateFolder(), 'models.sock')
+
+
+def _serverKey():
+    # The secret that clients of the model server must know, readable only by the user who runs it.
+    # It is kept in the private cache folder, and refused if anyone else could have read or written it.
+    filePath = os.path.join(_privateFolder(), 'models.key')
+    if not os.path.exists(filePath):
+        try:
+            fd = os.open(filePath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(hashlib.sha1(os.urandom(32)).hexdigest().encode())
+        except FileExistsError:
+            pass
+    if not _isPrivate(filePath) or (hasattr(os, 'getuid') and os.lstat(filePath).st_mode & 0o077):
+        raise PermissionError("Model server key {0} isn't private to the current user".format(filePath))
+    with open(filePath, 'rb') as f:
+        return f.read().strip()
+
+
+def _sendMessage(conn, header, array=None):
+    # A message is a JSON header, followed by the raw bytes of an array if the header has its shape.
+    # Nothing is pickled, so a peer can't make the other side run code.
+    np = __import__('numpy')
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header = dict(header, dtype=array.dtype.str, shape=array.shape)
+    conn.send_bytes(json.dumps(header).encode('utf-8'))
+    if array is not None:
+        conn.send_bytes(memoryview(array).cast('B'))
+
+
+def _receiveMessage(conn):
+    np = __import__('numpy')
+    header = json.loads(conn.recv_bytes().decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError("Expected a message header")
+    array = None
+    if 'shape' in header:
+        array = np.frombuffer(conn.recv_bytes(), dtype=np.dtype(header['dtype'])).reshape(header['shape'])
+    return header, array
+
+
+class ModelServer():
+    # Holds fitted models for all raster function workers on a machine, so that a large model is
+    # loaded once rather than by every process. Clients (RemoteModel) send blocks of pixel vectors
+    # and receive class probabilities. Requests that arrive together, from concurrent tiles or
+    # threads, are merged into one predict_proba call per model, of at most batchSize vectors.
+    # Only models of the given training files are served, and at most maxModels are kept loaded.
+    # Run it with: python mlutils.py --serve training_data.csv [more training files]
+
+    def __init__(self, datafiles, address=None, batchSize=262144, wait=0.002, timeout=600., maxModels=8):
+        self.datafiles = set(os.path.realpath(f) for f in datafiles)
+        self.address = address or serverAddress()
+        self.batchSize = int(batchSize)
+        self.wait = float(wait)
+        self.timeout = float(timeout)
+        self.loaded = LRUCache(maxModels)
+        self.requests = __import__('queue').Queue()
+
+    def serve(self):
+        threading = __import__('threading')
+        connection = __import__('multiprocessing.connection', fromlist=['Listener'])
+        if os.name != 'nt' and os.path.exists(self.address):
+            os.remove(self.address)                         # left over by a server that is gone
+
+        threading.Thread(target=self._batch, daemon=True).start()
+        with connection.Listener(self.address, authkey=_serverKey()) as listener:
+            print("Serving models at {0}".format(self.address), flush=True)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError):                 # failed authentication or a dropped client
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _open(self, header):
+        # Fits, or loads, the model of a served training file with trainModel. Only scikit-learn
+        # estimators can be requested.
+        importlib = __import__('importlib')
+        datafile, estimator, params = header.get('datafile'), header.get('estimator'), header.get('params') or {}
+        if not isinstance(datafile, str) or os.path.realpath(datafile) not in self.datafiles:
+            raise ValueError("Training file is not served: {0}".format(datafile))
+        if not isinstance(estimator, str) or not isinstance(params, dict):
+            raise ValueError("Expected an estimator name and a dictionary of parameters")
+        module, _, name = estimator.rpartition('.')
+        if module.split('.')[0] != 'sklearn':
+            raise ValueError("Not a scikit-learn estimator: {0}".format(estimator))
+        estimator = getattr(importlib.import_module(module), name)
+        model, _ = trainModel(os.path.realpath(datafile), estimator, **params)
+
+        key = json.dumps([os.path.realpath(datafile), header['estimator'], sorted(params.items())])
+        return key, self.loaded.put(key, model)
+
+    def _reply(self, header, x):
+        # Returns the reply header and array to a request. Raises on a malformed request.
+        threading = __import__('threading')
+        if header.get('op') == 'open':
+            key, model = self._open(header)
+            return {'model': key, 'classes': model.classes_.tolist()}, None
+        if header.get('op') != 'predict':
+            raise ValueError("Unknown operation: {0}".format(header.get('op')))
+
+        model = self.loaded.get(header.get('model'))
+        if model is None:                                   # never opened, or unloaded since
+            return {'error': 'Unknown model', 'unknown': True}, None
+        n = getattr(model, 'n_features_in_', None)
+        if x is None or x.ndim != 2 or x.dtype.kind not in 'biuf' or (n is not None and x.shape[1] != n):
+            raise ValueError("Expected an array of pixel vectors with {0} features".format(n))
+
+        request = {'model': model, 'x': x, 'done': threading.Event()}
+        self.requests.put(request)
+        if not request['done'].wait(self.timeout):
+            raise TimeoutError("No prediction within {0} seconds".format(self.timeout))
+        if 'error' in request:
+            raise request['error']
+        return {}, request['y']
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    header, x = _receiveMessage(conn)
+                except Exception:                           # a dropped client, or a garbled message
+                    return
+                try:
+                    reply, y = self._reply(header, x)
+                except Exception as e:
+                    reply, y = {'error': '{0}: {1}'.format(type(e).__name__, e)}, None
+                try:
+                    _sendMessage(conn, reply, y)
+                except (EOFError, OSError):
+                    return
+
+    def _batch(self):
+        queue = __import__('queue')
+        while True:
+            pending = [self.requests.get()]
+            try:
+                deadline = time() + self.wait
+                while sum(len(r['x']) for r in pending) < self.batchSize:
+                    try:
+                        pending.append(self.requests.get(timeout=max(0., deadline - time())))
+                    except queue.Empty:
+                        break
+
+                for model in {id(r['model']): r['model'] for r in pending}.values():
+                    self._predict(model, [r for r in pending if r['model'] is model])
+            except Exception as e:
+                for r in pending:
+                    if 'y' not in r:
+                        r.setdefault('error', e)
+            finally:
+                for r in pending:
+                    r['done'].set()
+
+    def _predict(self, model, batch):
+        # Predicts a batch of requests for one model at once. If that fails, each request is
+        # predicted on its own, so that a bad request fails only its own caller.
+        np = __import__('numpy')
+        try:
+            y = model.predict_proba(np.concatenate([r['x'] for r in batch]))
+            for r, j in zip(batch, np.cumsum([len(r['x']) for r in batch])):
+                r['y'] = y[j - len(r['x']):j]
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0]['error'] = e
+                return
+            for r in batch:
+                self._predict(model, [r])
+
+
+class RemoteModel():
+    # Stands in for a model held by a ModelServer: classes_ and predict_proba mirror the estimator,
+    # so it can be passed to classifyPixels. Each thread talks to the server on its own connection.
+    # Raises OSError if no server is listening at address, or if it doesn't serve the training file.
+
+    def __init__(self, datafile, estimator, address=None, **params):
+        np = __import__('numpy')
+        self.address = address or serverAddress()
+        self.local = __import__('threading').local()
+        self.header = {'op': 'open', 'datafile': os.path.abspath(datafile),
+                       'estimator': estimator.__module__ + '.' + estimator.__name__, 'params': params}
+        self._open()
+        self.classes_ = np.array(self.classes_)
+
+    def _open(self):
+        try:
+            reply = self._request(self.header)[0]
+        except RuntimeError as e:
+            raise OSError(str(e))
+        self.model, self.classes_ = reply['model'], reply['classes']
+
+    def _request(self, header, x=None):
+        connection = __import__('multiprocessing.connection', fromlist=['Client'])
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            try:
+                conn = self.local.conn = connection.Client(self.address, authkey=_serverKey())
+            except connection.AuthenticationError as e:
+                raise OSError("Model server at {0} refused the connection: {1}".format(self.address, e))
+        try:
+            _sendMessage(conn, header, x)
+            reply, y = _receiveMessage(conn)
+        except (EOFError, OSError):
+            self.local.conn = None
+            raise
+        if reply.get('unknown'):
+            raise LookupError("Model server: {0}".format(reply['error']))
+        if 'error' in reply:
+            raise RuntimeError("Model server: {0}".format(reply['error']))
+        return reply, y
+
+    def predict_proba(self, x):
+        try:
+            return self._request({'op': 'predict', 'model': self.model}, x)[1]
+        except LookupError:
+            classes = self.classes_
+            self._open()                                    # the server unloaded the model, load it again
+            self.classes_ = classes
+            return self._request({'op': 'predict', 'model': self.model}, x)[1]
+
+    def predict(self, x):
+        return self.classes_[self.predict_proba(x).argmax(axis=1)]
+
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- #
+
+def _persisted(key, compute, extension='.pkl', dump=None, load=None, timeout=3600.):
+    # Loads the result of compute() for key from the cache folder, or computes and saves it. Results are
+    # pickled, unless dump(value, file) and load(filePath) are given. A freshly saved result is loaded back
+    # through load, so that every process sees the same (possibly memory-mapped) value.
+    # A lock file ensures that concurrent worker processes don't repeat the same computation.
+    # Without a private cache folder, nothing is loaded or saved and compute() runs in this process.
+    try:
+        folder = _privateFolder()
+    except OSError:
+        return compute()
+
+    name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    filePath = os.path.join(folder, name + extension)
+    lockPath = filePath + '.lock'
+
+    while True:
+        if os.path.isfile(filePath):
+            try:
+                if load is not None:
+                    return load(filePath)
+                with open(filePath, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                pass                            # partial, incompatible or refused file, recompute below
+        try:
+            fd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+            break
+        except OSError:
+            try:
+                if time() - os.path.getmtime(lockPath) > timeout:
+                    os.remove(lockPath)         # owner of a stale lock died
+            except OSError:
+                pass
+            sleep(0.1)
+
+    try:
+        value = compute()
+        tempPath = '{0}.{1}.tmp'.format(filePath, os.getpid())
+        if os.path.lexists(tempPath):
+            os.remove(tempPath)                 # left over by a process that had the same id
+        with os.fdopen(os.open(tempPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600), 'wb') as f:
+            if dump is not None:                # private whatever the umask, as loading requires
+                dump(value, f)
+            else:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tempPath, filePath)
+        if load is None:
+            return value
+        try:
+            return load(filePath)
+        except OSError:
+            return value                        # the saved file was refused, use the computed value
+    finally:
+        os.close(fd)
+        os.remove(lockPath)
+
+
+def _privateFolder():
+    # Returns the cache folder, created accessible by the current user only. Pickles are loaded from it,
+    # so a folder that another user owns or can write to is refused with PermissionError.
+    try:
+        os.makedirs(cacheFolder, mode=0o700)
+    except FileExistsError:
+        pass
+    if not _isPrivate(cacheFolder, folder=True):
+        raise PermissionError("Cache folder {0} must be owned by, and writable only by, the current user".format(cacheFolder))
+    return cacheFolder
+
+
+def _isPrivate(path, folder=False):
+    # whether path is a folder (or a regular file) that only the current user owns and can write to.
+    # Windows keeps temporary folders per user, and has no owner ids to compare.
+    st = os.lstat(path)
+    if not (S_ISDIR if folder else S_ISREG)(st.st_mode):
+        return False
+    return not hasattr(os, 'getuid') or (st.st_uid == os.getuid() and not st.st_mode & 0o022)
+
+
+# Flat array files: a small pickled header followed by the raw data of each numeric array, 64-byte aligned.
+# The header holds the structure of the saved value, with each array replaced by its dtype, shape and offset.
+
+arrayFileMagic = b'RFARRAY1'
+
+def _mapArchive(filePath):
+    # Returns the arrays of an .npz file by name. Arrays stored without compression are memory-mapped
+    # read-only, the others are read. Object arrays, which would need unpickling, are refused.
+    np = __import__('numpy')
+    zipfile = __import__('zipfile')
+    fmt = np.lib.format
+    readers = {(1, 0): fmt.read_array_header_1_0, (2, 0): fmt.read_array_header_2_0}
+    arrays = {}
+    with zipfile.ZipFile(filePath) as archive, open(filePath, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = fmt.read_array(member, allow_pickle=False)
+                continue
+
+            # the member's data follows its local header, whose name and extra fields vary in length
+            f.seek(info.header_offset + 26)
+            nameLength, extraLength = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + nameLength + extraLength)
+            version = fmt.read_magic(f)
+            if version not in readers:
+                f.seek(info.header_offset + 30 + nameLength + extraLength)
+                arrays[name] = fmt.read_array(f, allow_pickle=False)
+                continue
+            shape, fortran, dtype = readers[version](f)
+            if dtype.hasobject:
+                raise ValueError("Object arrays are not supported: {0} in {1}".format(name, filePath))
+            if not int(np.prod(shape)):
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(filePath, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                     order='F' if fortran else 'C')
+    return arrays
+
+
+class _ArrayRef(object):
+    def __init__(self, dtype, shape, offset):
+        self.dtype, self.shape, self.offset = dtype, shape, offset
+
+
+def _dumpArrays(value, f):
+    np = __import__('numpy')
+    arrays = []
+
+    def strip(v):
+        if isinstance(v, tuple):
+            return tuple(strip(z) for z in v)
+        if isinstance(v, list):
+            return [strip(z) for z in v]
+        if isinstance(v, np.ndarray) and not v.dtype.hasobject:
+            offset = sum((a.nbytes + 63) // 64 * 64 for a in arrays)
+            arrays.append(np.ascontiguousarray(v))
+            return _ArrayRef(v.dtype, v.shape, offset)
+        return v
+
+    header = pickle.dumps(strip(value), pickle.HIGHEST_PROTOCOL)
+    start = (len(arrayFileMagic) + 8 + len(header) + 63) // 64 * 64
+
+    f.write(arrayFileMagic)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    offset = 0
+    for a in arrays:
+        f.seek(start + offset)
+        f.write(a.tobytes())
+        offset += (a.nbytes + 63) // 64 * 64
+
+
+def _loadArrays(filePath):
+    # The header is unpickled, so only files that the current user alone could have written are read.
+    np = __import__('numpy')
+    if not (_isPrivate(filePath) and _isPrivate(os.path.dirname(os.path.abspath(filePath)), folder=True)):
+        raise PermissionError("Flat array file {0} isn't private to the current user".format(filePath))
+    with open(filePath, 'rb') as f:
+        if f.read(len(arrayFileMagic)) != arrayFileMagic:
+            raise ValueError("Not a flat array file: {0}".format(filePath))
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = pickle.loads(f.read(n))
+        start = (f.tell() + 63) // 64 * 64
+
+    def fill(v):
+        if isinstance(v, tuple):
+            return tuple(fill(z) for z in v)
+        if isinstance(v, list):
+            return [fill(z) for z in v]
+        if isinstance(v, _ArrayRef):
+            if not int(np.prod(v.shape)):
+                return np.empty(v.shape, dtype=v.dtype)     # empty arrays can't be mapped
+            return np.memmap(filePath, dtype=v.dtype, mode='r', offset=start + v.offset, shape=v.shape)
+        return v
+
+    return fill(header)
+
+
+if __name__ == '__main__':
+    # python mlutils.py training_data.csv [training_data.npz]
+    # python mlutils.py --serve training_data.csv [more training files]
+    # The server listens at RASTER_FUNCTIONS_SERVER, or at the default address of serverAddress.
+    import sys
+    if sys.argv[1:2] == ['--serve']:
+        ModelServer(sys.argv[2:]).serve()
+    else:
+        print(convertTrainingData(*sys.argv[1:3]))
@@ -19,6 +19,9 @@ __all__ = ['isProductVersionOK',
            'Projection',
            'Trace',
            'ZonalAttributesTable',
+           'TimeIndex',
+           'LRUCache',
+           'terrainDerivatives',
            'projectCellSize',]
 
 
@@ -53,8 +56,14 @@ def computeCellSize(props, sr=None, proj=None):
     return (xMax-xMin)/w, (yMax-yMin)/h                         # cell size of parent raster
 
 def projectCellSize(cellSize, inSR, outSR, proj=None):
-    inSRS = proj.createSR(inSR)
-    outSRS = proj.createSR(outSR)
+    # memoized per cell size and pair of spatial references, the projection is the same for every tile
+    key = (tuple(cellSize), spatialReferenceKey(inSR), spatialReferenceKey(outSR))
+    return cellSizeCache.lookup(key, lambda: _projectCellSize(cellSize, inSR, outSR))
+
+
+def _projectCellSize(cellSize, inSR, outSR):
+    inSRS = createSpatialReference(inSR)
+    outSRS = createSpatialReference(outSR)
     if isGeographic(inSR) and isGeographic(outSR):
         x =  cellSize[0] * (inSRS.radiansPerUnit/outSRS.radiansPerUnit)
         y = cellSize[1] * (inSRS.radiansPerUnit/outSRS.radiansPerUnit)
@@ -85,10 +94,26 @@ def projectCellSize(cellSize, inSR, outSR, proj=None):
 
 
 def isGeographic(s):
-    arcpy = __import__('arcpy')
-    sr = arcpy.SpatialReference()
-    sr.loadFromString(str(s) if isinstance(s, (str, int)) else s.exportToString())
-    return bool(sr.type == 'Geographic' and sr.angularUnitName)
+    def compute():
+        sr = createSpatialReference(s)
+        return bool(sr.type == 'Geographic' and sr.angularUnitName)
+    return geographicCache.lookup(spatialReferenceKey(s), compute)
+
+
+def spatialReferenceKey(s):
+    # WKID or WKT identifying a spatial reference given as a string, a WKID, or an arcpy object
+    if isinstance(s, (str, int)):
+        return str(s)
+    return str(getattr(s, 'factoryCode', 0) or s.exportToString())
+
+
+def createSpatialReference(s):
+    # shared arcpy spatial reference objects, created once per WKID or WKT. Don't modify them.
+    def create():
+        sr = __import__('arcpy').SpatialReference()
+        sr.loadFromString(str(s) if isinstance(s, (str, int)) else s.exportToString())
+        return sr
+    return spatialReferenceCache.lookup(spatialReferenceKey(s), create)
 
 
 def loadJSON(s):
@@ -114,19 +139,15 @@ class Projection():
         self.inSR, self.outSR = None, None
 
     def transform(self, inSR, outSR, x, y):
-        if self.inSR != inSR:
-            self.inSR = self.createSR(inSR)
-        if self.outSR != outSR:
-            self.outSR = self.createSR(outSR)
-    
+        self.inSR = self.createSR(inSR)
+        self.outSR = self.createSR(outSR)
+
         p = self.arcpy.PointGeometry(self.arcpy.Point(x, y), self.inSR, False, False)
         q = p.projectAs(self.outSR)
         return q.firstPoint.X, q.firstPoint.Y
 
     def createSR(self, s):
-        sr = self.arcpy.SpatialReference()
-        sr.loadFromString(str(s) if isinstance(s, (str, int)) else s.exportToString())
-        return sr
+        return createSpatialReference(s)
 
 
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- #
@@ -256,3 +277,179 @@ class ZonalAttributesTable():
 
     def _addAttributes(self, T, zoneId, attribValues):
         T[zoneId] = T.get(zoneId, []) + [attribValues]
+
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- #
+
+
+class TimeIndex():
+    # Decodes the acquisition times of a raster collection (as returned in rasters_keyMetadata) once,
+    # so that time-aware functions can reuse sort orders and date filters on every pixel block.
+    # Times are serial dates, i.e. days since 1899-12-30 (OLE automation date).
+
+    epoch = '1899-12-30'
+
+    def __init__(self, keyMetadata, key='acquisitiondate'):
+        np = __import__('numpy')
+        self.np = np
+
+        self.serial = np.array([float(k[key]) for k in (keyMetadata or [])], dtype='f8')
+        self.times = np.datetime64(self.epoch, 'us') + np.round(self.serial * 86400e6).astype('i8').astype('timedelta64[us]')
+        self.order = np.argsort(self.serial, kind='stable')     # indices that chronologically order the collection
+        self.sorted = self.times[self.order]
+
+        years = self.times.astype('datetime64[Y]')
+        self.year = years.astype('i8') + 1970
+        self.month = self.times.astype('datetime64[M]').astype('i8') % 12 + 1
+        self.doy = (self.times.astype('datetime64[D]') - years.astype('datetime64[D]')).astype('i8') + 1
+        self.windows = {}
+
+    def __len__(self):
+        return len(self.serial)
+
+    def window(self, start=None, end=None):
+        # indices of rasters acquired within [start, end], both inclusive. start and end are datetime objects.
+        k = ('window', start, end)
+        if k not in self.windows:
+            v = self.np.ones(len(self.times), dtype=bool)
+            if start is not None:
+                v &= self.times >= self.np.datetime64(start, 'us')
+            if end is not None:
+                v &= self.times <= self.np.datetime64(end, 'us')
+            self.windows[k] = self.np.flatnonzero(v)
+        return self.windows[k]
+
+    def filter(self, years=None, days=None, months=None):
+        # indices of rasters whose year, day of year, and month fall within the given inclusive (min, max) ranges.
+        k = ('filter', years, days, months)
+        if k not in self.windows:
+            v = self.np.ones(len(self.times), dtype=bool)
+            for r, a in ((years, self.year), (days, self.doy), (months, self.month)):
+                if r is not None:
+                    v &= (a >= r[0]) & (a <= r[1])
+            self.windows[k] = self.np.flatnonzero(v)
+        return self.windows[k]
+
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- #
+
+
+class LRUCache():
+    # A bounded, thread-safe mapping that evicts the least recently used entry.
+    # capacity is the number of entries, or, given sizeOf, the total size of their values.
+    def __init__(self, capacity=8, sizeOf=None):
+        self.capacity = max(1, int(capacity))
+        self.sizeOf = sizeOf or (lambda value: 1)
+        self.size = 0
+        self.items = __import__('collections').OrderedDict()
+        self.lock = __import__('threading').RLock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.sizeOf(self.items[key])
+            self.items[key] = value
+            self.items.move_to_end(key)
+            self.size += self.sizeOf(value)
+            while self.size > self.capacity and self.items:
+                self.size -= self.sizeOf(self.items.popitem(last=False)[1])
+        return value
+
+    def lookup(self, key, compute):
+        # returns the cached value for key, calling compute() to create it on a miss.
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        return self.put(key, compute())
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+# spatial references, their geographic flags, and projected cell sizes, shared by all functions in this process
+spatialReferenceCache = LRUCache(32)
+geographicCache = LRUCache(32)
+cellSizeCache = LRUCache(64)
+
+def terrainDerivatives(z, cellSize, zFactor=1., products=('slope',), azimuth=315., altitude=45.):
+    # Computes terrain products of a DEM block padded by one cell on each side, in float32 and in one pass
+    # of slice arithmetic over the 3x3 neighborhood of every inner cell [1]. Returns a tuple with one
+    # (H-2) x (W-2) array per name in products:
+    #   dzdx, dzdy:     surface gradient towards east and north, in z units per cell-size unit
+    #   slope:          slope in degrees; percentSlope: slope in percent rise
+    #   aspect:         compass direction of the downhill slope in degrees, -1 for flat cells
+    #   hillshade:      illumination from the given azimuth and altitude (in degrees), 0-255. With sequences
+    #                   of azimuths and altitudes, a stack with the illumination from each direction.
+    #   curvature:      curvature of the surface [2], in hundredths of z units per cell-size unit squared
+    # zFactor is a scalar or an (x, y) pair.
+    np = __import__('numpy')
+    z = np.asarray(z, dtype='f4')
+    px, py = (cellSize, cellSize) if np.isscalar(cellSize) else cellSize
+    zx, zy = (zFactor, zFactor) if np.isscalar(zFactor) else zFactor
+
+    a, b, c = z[:-2, :-2], z[:-2, 1:-1], z[:-2, 2:]
+    d, f = z[1:-1, :-2], z[1:-1, 2:]
+    g, h, i = z[2:, :-2], z[2:, 1:-1], z[2:, 2:]
+    sx, sy = (c + 2*f + i) - (a + 2*d + g), (a + 2*b + c) - (g + 2*h + i)
+
+    dx, dy = sx * np.float32(zx / (8.*px)), sy * np.float32(zy / (8.*py))
+    rise = None
+    out = []
+    for name in products:
+        if name == 'dzdx':
+            out.append(dx)
+        elif name == 'dzdy':
+            out.append(dy)
+        elif name in ('slope', 'percentSlope'):
+            rise = np.sqrt(dx*dx + dy*dy) if rise is None else rise
+            out.append(np.degrees(np.arctan(rise)) if name == 'slope' else rise * np.float32(100.))
+        elif name == 'aspect':
+            aspect = np.degrees(np.arctan2(-dx, -dy))
+            aspect[aspect < 0] += np.float32(360.)
+            aspect[(dx == 0) & (dy == 0)] = -1
+            out.append(aspect)
+        elif name == 'hillshade':
+            norm = np.sqrt(1 + (dx*dx + dy*dy))
+            Z, A = np.broadcast_arrays(np.radians(90. - np.atleast_1d(altitude)),    # zenith and
+                                       np.radians(90. - np.atleast_1d(azimuth)))     # arithmetic azimuth
+            h = np.empty((len(Z),) + norm.shape, dtype='f4')
+            for k in range(len(Z)):
+                sinZsinA, sinZcosA = np.float32(np.sin(Z[k])*np.sin(A[k])), np.float32(np.sin(Z[k])*np.cos(A[k]))
+                np.clip(255 * ((np.float32(np.cos(Z[k])) - dy*sinZsinA - dx*sinZcosA) / norm), 0, 255, out=h[k])
+            out.append(h if np.ndim(azimuth) or np.ndim(altitude) else h[0])
+        elif name == 'curvature':
+            e = z[1:-1, 1:-1]
+            D = ((z[1:-1, :-2] + z[1:-1, 2:]) / 2 - e) * np.float32(zx / (px*px))
+            E = ((z[:-2, 1:-1] + z[2:, 1:-1]) / 2 - e) * np.float32(zy / (py*py))
+            out.append(-200 * (D + E))
+        else:
+            raise ValueError("Unknown terrain product: {0}".format(name))
+    return tuple(out)
+
+
+"""
+References:
+
+    [1]. Burrough, P. A. and McDonell, R. A., 1998.
+    Principles of Geographical Information Systems. Oxford University Press, New York, 190 pp.
+
+    [2]. Zevenbergen, L. W. and Thorne, C. R., 1987.
+    Quantitative analysis of land surface topography. Earth Surface Processes and Landforms, 12(1), 47-56.
+"""